@@ -1,11 +1,14 @@
 import streamlit as st
 import pandas as pd
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 import database as db
+import forecast
+import search
 
 # ─── Initialize ──────────────────────────────────────────────────────────────
 
 db.init_db()
+db.start_background_refresher()
 
 st.set_page_config(
     page_title="📦 Sukiism Stock",
@@ -114,27 +117,52 @@ st.markdown("""
 
 CATEGORIES = ["เนื้อสัตว์", "อาหารทะเล","อาหารสำเร็จ", "ไข่/นม", "ของแห้ง"]
 
+# ─── Item Picker ─────────────────────────────────────────────────────────────
+
+PICKER_LIMIT = 30
+
+
+def item_picker(key: str, label, container=st, include_all: bool = False):
+    """Search-as-you-type item picker; returns the chosen item dict (None = ทั้งหมด)."""
+    query = container.text_input("🔍 ค้นหาวัตถุดิบ", key=f"{key}_q",
+                                 placeholder="รหัส / ชื่อ / หมวดหมู่")
+    matches = {it["รหัส"]: it for it in search.search_items(query, limit=PICKER_LIMIT)}
+    if not matches:
+        container.caption("ไม่พบวัตถุดิบที่ค้นหา — แสดงรายการที่ใช้บ่อย")
+        matches = {it["รหัส"]: it for it in search.search_items("", limit=PICKER_LIMIT)}
+    options = ([None] if include_all else []) + list(matches)
+    code = container.selectbox(
+        "📦 เลือกวัตถุดิบ", options, key=key,
+        format_func=lambda c: "ทั้งหมด" if c is None else label(matches[c]),
+    )
+    return matches.get(code)
+
 # ─── Sidebar Navigation ─────────────────────────────────────────────────────
 
+BRANCHES = list(db.get_branches())
+
 with st.sidebar:
     st.markdown("## 📦 Sukiism")
+    if len(BRANCHES) > 1:
+        st.selectbox("🏢 สาขา", BRANCHES, index=BRANCHES.index(db.get_current_branch()), key="branch")
     st.markdown("---")
 
+    menu = ["📊 Dashboard", "📦 จัดการ Stock", "➕ รับเข้า", "🔻 จ่ายออก", "📋 Transactions", "🛒 แนะนำการสั่ง",
+            "📥 นำเข้า / ส่งออก"]
+    if len(BRANCHES) > 1:
+        menu.append("🏢 ภาพรวมทุกสาขา")
     page = st.radio(
         "เมนู",
-        ["📊 Dashboard", "📦 จัดการ Stock", "➕ รับเข้า", "🔻 จ่ายออก", "📋 Transactions"],
+        menu,
         label_visibility="collapsed",
     )
 
     st.markdown("---")
     if st.button("🔄 Refresh ข้อมูล", use_container_width=True):
         db.clear_all_cache()
+        db.clear_materialized()
         st.rerun()
-    st.markdown(
-        "<p style='font-size:0.7rem;color:#64748b;text-align:center;'>"
-        "ข้อมูล cache อัตโนมัติ 60 วินาที<br>กด Refresh เพื่ออัพเดทล่าสุด</p>",
-        unsafe_allow_html=True,
-    )
+    sync_note = st.empty()  # filled in at the end of the run, after data is loaded
     st.markdown("---")
     st.markdown(
         f"<p style='font-size:0.75rem;color:#94a3b8;text-align:center;'>"
@@ -151,65 +179,116 @@ if page == "📊 Dashboard":
     st.markdown('<p class="page-header">📊 Dashboard</p>', unsafe_allow_html=True)
     st.markdown('<p class="page-subheader">ภาพรวมสต็อกวัตถุดิบ Sukiism</p>', unsafe_allow_html=True)
 
-    items = db.get_all_items()
-    restock = db.get_restock_report()
+    items_df = db.get_items_frame()
+    restock_df = items_df[items_df["สถานะสต็อก"] == db.STOCK_STATUS_LOW]
     today_tx = db.get_today_transaction_count()
 
     # ── Metrics ──
-    total_value = sum(it["มูลค่าคงเหลือ"] for it in items)
+    total_value = items_df["มูลค่าคงเหลือ"].sum()
     col1, col2, col3, col4 = st.columns(4)
-    col1.metric("🗂️ สินค้าทั้งหมด", len(items))
-    col2.metric("⚠️ ต่ำกว่ามาตรฐาน", len(restock))
+    col1.metric("🗂️ สินค้าทั้งหมด", len(items_df))
+    col2.metric("⚠️ ต่ำกว่ามาตรฐาน", len(restock_df))
     col3.metric("📝 Transactions วันนี้", today_tx)
     col4.metric("💰 มูลค่ารวม", f"฿{total_value:,.0f}")
 
     st.markdown("---")
 
     # ── Restock Alerts ──
-    if restock:
+    if not restock_df.empty:
         st.markdown("### 🔴 ต้องสั่งเพิ่ม")
-        for item in restock:
-            with st.container():
-                c1, c2, c3, c4 = st.columns([3, 2, 2, 2])
-                c1.markdown(f"**{item['รหัส']}** {item['รายการวัตถุดิบ']}")
-                c2.markdown(f"คงเหลือ: **{item['คงเหลือจริง']:.1f}** {item['หน่วยนับ']}")
-                c3.markdown(f"ขั้นต่ำ: **{item['สต็อกขั้นต่ำ']:.1f}** {item['หน่วยนับ']}")
-                c4.markdown(
-                    f'<span class="status-low">ต้องเติม {item["need_to_restock"]:.1f} {item["หน่วยนับ"]}</span>',
-                    unsafe_allow_html=True,
-                )
+        st.dataframe(
+            restock_df[["รหัส", "รายการวัตถุดิบ", "หน่วยนับ", "คงเหลือจริง", "สต็อกขั้นต่ำ", "need_to_restock"]],
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "รายการวัตถุดิบ": st.column_config.TextColumn("รายการ"),
+                "คงเหลือจริง": st.column_config.NumberColumn("คงเหลือ", format="%.1f"),
+                "สต็อกขั้นต่ำ": st.column_config.NumberColumn("ขั้นต่ำ", format="%.1f"),
+                "need_to_restock": st.column_config.NumberColumn("ต้องเติม", format="%.1f"),
+            },
+        )
         st.markdown("---")
     else:
-        if items:
+        if not items_df.empty:
             st.success("✅ สต็อกทุกรายการอยู่ในระดับปกติ!")
         st.markdown("---")
 
+    # ── Expiring Lots (FEFO lot ledger) ──
+    ec1, ec2 = st.columns([3, 1])
+    ec1.markdown("### ⏳ ใกล้หมดอายุ")
+    within_days = ec2.number_input("ภายใน (วัน)", min_value=0, max_value=60, value=3, step=1)
+    expiring = db.get_expiring_lots(int(within_days))
+    if expiring:
+        exp_df = pd.DataFrame(expiring)
+        names = items_df.drop_duplicates("รหัส").set_index("รหัส")["รายการวัตถุดิบ"]
+        exp_df.insert(1, "รายการ", exp_df["รหัส"].map(names).fillna(""))
+        st.dataframe(
+            exp_df,
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "รับเข้า": st.column_config.DateColumn(format="DD/MM/YYYY"),
+                "หมดอายุ": st.column_config.DateColumn(format="DD/MM/YYYY"),
+                "คงเหลือ": st.column_config.NumberColumn(format="%.1f"),
+            },
+        )
+    else:
+        st.success(f"✅ ไม่มีล็อตที่จะหมดอายุภายใน {int(within_days)} วัน")
+    st.markdown("---")
+
     # ── Full Stock Table ──
-    st.markdown("### 📦 สต็อกทั้งหมด")
-    if items:
-        df = pd.DataFrame(items)
-        display_cols = ["รหัส", "รายการวัตถุดิบ", "หมวดหมู่", "หน่วยนับ", "ราคา/หน่วย",
+    sc1, sc2 = st.columns([3, 1])
+    sc1.markdown("### 📦 สต็อกทั้งหมด")
+    as_of = sc2.date_input("📅 ณ วันที่", value=db.thai_today(), max_value=db.thai_today())
+    if not items_df.empty and as_of < db.thai_today():
+        snapshot = db.get_stock_as_of(as_of)
+        st.metric(f"💰 มูลค่ารวม ณ {as_of.strftime('%d/%m/%Y')}", f"฿{snapshot['มูลค่าคงเหลือ'].sum():,.0f}")
+        st.dataframe(
+            snapshot[["รหัส", "รายการวัตถุดิบ", "หมวดหมู่", "หน่วยนับ", "ราคา/หน่วย",
+                      "รับเข้าสะสม", "จ่ายออกสะสม", "คงเหลือ", "มูลค่าคงเหลือ"]],
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "ราคา/หน่วย": st.column_config.NumberColumn(format="฿%.0f"),
+                "รับเข้าสะสม": st.column_config.NumberColumn(format="%.1f"),
+                "จ่ายออกสะสม": st.column_config.NumberColumn(format="%.1f"),
+                "คงเหลือ": st.column_config.NumberColumn(format="%.1f"),
+                "มูลค่าคงเหลือ": st.column_config.NumberColumn(format="฿%.0f"),
+            },
+        )
+        st.caption("คำนวณจากรายการที่อนุมัติแล้วจนถึงสิ้นวันที่เลือก • มูลค่าคิดจากราคาปัจจุบัน")
+    elif not items_df.empty:
+        display_cols = ["สถานะสต็อก", "รหัส", "รายการวัตถุดิบ", "หมวดหมู่", "หน่วยนับ", "ราคา/หน่วย",
                         "สต็อกขั้นต่ำ", "คงเหลือจริง", "สถานะการสั่ง", "มูลค่าคงเหลือ", "อายุการเก็บ (วัน)"]
-        df = df[[c for c in display_cols if c in df.columns]]
-
-        def highlight_row(row):
-            if "คงเหลือจริง" in row and "สต็อกขั้นต่ำ" in row:
-                if row["คงเหลือจริง"] < row["สต็อกขั้นต่ำ"]:
-                    return ["background-color: #fee2e2"] * len(row)
-                elif row["คงเหลือจริง"] < row["สต็อกขั้นต่ำ"] * 1.2:
-                    return ["background-color: #fef3c7"] * len(row)
-            return ["background-color: #dcfce7"] * len(row)
-
-        styled = df.style.apply(highlight_row, axis=1).format({
-            "ราคา/หน่วย": "฿{:.0f}",
-            "สต็อกขั้นต่ำ": "{:.1f}",
-            "คงเหลือจริง": "{:.1f}",
-            "มูลค่าคงเหลือ": "฿{:,.0f}",
-        })
-        st.dataframe(styled, use_container_width=True, hide_index=True)
+        st.dataframe(
+            items_df[display_cols],
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "สถานะสต็อก": st.column_config.TextColumn("สถานะ"),
+                "ราคา/หน่วย": st.column_config.NumberColumn(format="฿%.0f"),
+                "สต็อกขั้นต่ำ": st.column_config.NumberColumn(format="%.1f"),
+                "คงเหลือจริง": st.column_config.NumberColumn(format="%.1f"),
+                "มูลค่าคงเหลือ": st.column_config.NumberColumn(format="฿%.0f"),
+            },
+        )
     else:
         st.info("ยังไม่มีสินค้าในระบบ กรุณาเพิ่มที่เมนู **📦 จัดการ Stock**")
 
+    # ── Movement Trend (from materialized daily aggregates) ──
+    trend_start = db.thai_today() - timedelta(days=29)
+    moves = db.get_daily_movements(start=trend_start)
+    if not moves.empty:
+        st.markdown("### 📈 มูลค่าการเคลื่อนไหว 30 วันล่าสุด")
+        prices = items_df.drop_duplicates("รหัส").set_index("รหัส")["ราคา/หน่วย"]
+        price = moves["รหัส"].map(prices).fillna(0.0)
+        trend = (
+            moves.assign(รับเข้า=moves["รับเข้า"] * price, จ่ายออก=moves["จ่ายออก"] * price)
+            .groupby("วันที่")[["รับเข้า", "จ่ายออก"]].sum()
+            .reindex(pd.date_range(trend_start, db.thai_today()).date, fill_value=0.0)
+        )
+        st.line_chart(trend, y_label="฿")
+
 
 # ═══════════════════════════════════════════════════════════════════════════
 #  PAGE 2 : จัดการ STOCK
@@ -260,37 +339,45 @@ elif page == "📦 จัดการ Stock":
     else:
         for item in items:
             label = f"**{item['รหัส']}** {item['รายการวัตถุดิบ']} — {item['คงเหลือจริง']:.1f} {item['หน่วยนับ']} | {item['หมวดหมู่']}"
+            code = item["รหัส"]
             with st.expander(label):
-                with st.form(f"edit_{item['row_num']}"):
+                if not code:
+                    st.warning("⚠️ รายการนี้ไม่มีรหัส กรุณาแก้ไขในชีตโดยตรง")
+                    continue
+                key = f"{code}_{item['row_num']}"  # unique even if two rows share a code
+                with st.form(f"edit_{key}"):
                     st.markdown(f"📌 รหัส: **{item['รหัส']}** *(สร้างอัตโนมัติ)*")
-                    edit_name = st.text_input("ชื่อ", value=item["รายการวัตถุดิบ"], key=f"name_{item['row_num']}")
+                    edit_name = st.text_input("ชื่อ", value=item["รายการวัตถุดิบ"], key=f"name_{key}")
 
                     ec3, ec4, ec5 = st.columns(3)
                     cat_idx = CATEGORIES.index(item["หมวดหมู่"]) if item["หมวดหมู่"] in CATEGORIES else len(CATEGORIES) - 1
-                    edit_cat = ec3.selectbox("หมวดหมู่", CATEGORIES, index=cat_idx, key=f"cat_{item['row_num']}")
-                    edit_unit = ec4.text_input("หน่วย", value=item["หน่วยนับ"], key=f"unit_{item['row_num']}")
+                    edit_cat = ec3.selectbox("หมวดหมู่", CATEGORIES, index=cat_idx, key=f"cat_{key}")
+                    edit_unit = ec4.text_input("หน่วย", value=item["หน่วยนับ"], key=f"unit_{key}")
                     edit_price = ec5.number_input("ราคา/หน่วย", value=float(item["ราคา/หน่วย"]),
-                                                   min_value=0.0, step=10.0, key=f"price_{item['row_num']}")
+                                                   min_value=0.0, step=10.0, key=f"price_{key}")
 
                     ec6, ec7 = st.columns(2)
                     edit_min = ec6.number_input("ขั้นต่ำ", value=float(item["สต็อกขั้นต่ำ"]),
-                                                min_value=0.0, step=1.0, key=f"min_{item['row_num']}")
+                                                min_value=0.0, step=1.0, key=f"min_{key}")
                     edit_shelf = ec7.number_input("อายุการเก็บ (วัน)", value=int(item["อายุการเก็บ (วัน)"]),
-                                                   min_value=1, step=1, key=f"shelf_{item['row_num']}")
+                                                   min_value=1, step=1, key=f"shelf_{key}")
 
                     bc1, bc2 = st.columns(2)
                     save = bc1.form_submit_button("💾 บันทึก", use_container_width=True)
                     delete = bc2.form_submit_button("🗑️ ลบ", use_container_width=True)
 
-                    if save:
-                        db.update_item(item["row_num"], edit_name, edit_cat,
-                                       edit_unit, edit_price, edit_min, edit_shelf)
-                        st.success("✅ บันทึกแล้ว!")
-                        st.rerun()
-                    if delete:
-                        db.delete_item(item["row_num"])
-                        st.success("🗑️ ลบแล้ว!")
-                        st.rerun()
+                    try:
+                        if save:
+                            db.update_item(code, edit_name, edit_cat,
+                                           edit_unit, edit_price, edit_min, edit_shelf)
+                            st.success("✅ บันทึกแล้ว!")
+                            st.rerun()
+                        if delete:
+                            db.delete_item(code)
+                            st.success("🗑️ ลบแล้ว!")
+                            st.rerun()
+                    except ValueError as e:
+                        st.error(f"❌ {e}")
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -306,9 +393,9 @@ elif page == "➕ รับเข้า":
     if not items:
         st.warning("ยังไม่มีสินค้าในระบบ กรุณาเพิ่มสินค้าก่อน")
     else:
-        item_options = {f"{it['รหัส']} — {it['รายการวัตถุดิบ']} ({it['คงเหลือจริง']:.1f} {it['หน่วยนับ']})": it for it in items}
-        selected_label = st.selectbox("🔍 เลือกวัตถุดิบ", options=list(item_options.keys()), key="si_item")
-        selected_item = item_options[selected_label]
+        selected_item = item_picker(
+            "si_item", lambda it: f"{it['รหัส']} — {it['รายการวัตถุดิบ']} ({it['คงเหลือจริง']:.1f} {it['หน่วยนับ']})"
+        )
 
         rc1, rc2 = st.columns(2)
         qty = rc1.number_input(
@@ -360,9 +447,9 @@ elif page == "🔻 จ่ายออก":
     if not items:
         st.warning("ยังไม่มีสินค้าในระบบ กรุณาเพิ่มสินค้าก่อน")
     else:
-        item_options = {f"{it['รหัส']} — {it['รายการวัตถุดิบ']} (คงเหลือ {it['คงเหลือจริง']:.1f} {it['หน่วยนับ']})": it for it in items}
-        selected_label = st.selectbox("🔍 เลือกวัตถุดิบ", options=list(item_options.keys()), key="so_item")
-        selected_item = item_options[selected_label]
+        selected_item = item_picker(
+            "so_item", lambda it: f"{it['รหัส']} — {it['รายการวัตถุดิบ']} (คงเหลือ {it['คงเหลือจริง']:.1f} {it['หน่วยนับ']})"
+        )
 
         wc1, wc2 = st.columns(2)
         max_qty = float(selected_item["คงเหลือจริง"]) if selected_item["คงเหลือจริง"] > 0 else 0.1
@@ -376,6 +463,15 @@ elif page == "🔻 จ่ายออก":
         )
         requester = wc2.text_input("👤 ผู้ทำรายการ", placeholder="เช่น a002", key="so_req")
 
+        lots = db.get_item_lots(selected_item["รหัส"])
+        if lots:
+            first_lot = lots[0]
+            st.info(
+                f"📦 ควรหยิบล็อตที่รับเข้า **{first_lot['รับเข้า'].strftime('%d/%m/%Y')}** ก่อน "
+                f"(หมดอายุ {first_lot['หมดอายุ'].strftime('%d/%m/%Y')}, "
+                f"เหลือ {first_lot['เหลือ(วัน)']} วัน, คงเหลือ {first_lot['คงเหลือ']:.1f} {selected_item['หน่วยนับ']})"
+            )
+
         if st.button("🔻 บันทึกจ่ายออก", use_container_width=True, key="so_submit"):
             if qty <= 0:
                 st.error("❌ กรุณาระบุจำนวนที่มากกว่า 0")
@@ -416,48 +512,286 @@ elif page == "📋 Transactions":
     st.markdown('<p class="page-header">📋 Transactions</p>', unsafe_allow_html=True)
     st.markdown('<p class="page-subheader">ประวัติการเคลื่อนไหวของสต็อก (RP-PO)</p>', unsafe_allow_html=True)
 
-    items = db.get_all_items()
-
     # ── Filters ──
     st.markdown("### 🔍 ตัวกรอง")
     fc1, fc2, fc3 = st.columns(3)
 
-    filter_date = fc1.date_input("📅 วันที่", value=db.thai_today())
+    all_dates = fc1.checkbox("📅 ทุกวันที่", value=False)
+    filter_date = None if all_dates else fc1.date_input("📅 วันที่", value=db.thai_today())
 
     filter_type = fc2.selectbox("📂 ประเภท", ["ทั้งหมด", "รับเข้า", "จ่ายออก"])
     filter_tx_type = None if filter_type == "ทั้งหมด" else filter_type
 
-    item_filter_options = ["ทั้งหมด"] + [f"{it['รหัส']} — {it['รายการวัตถุดิบ']}" for it in items]
-    filter_item_label = fc3.selectbox("📦 สินค้า", item_filter_options)
-    filter_item_code = None
-    if filter_item_label != "ทั้งหมด":
-        filter_item_code = filter_item_label.split(" — ")[0].strip()
+    filter_item = item_picker("tx_item", lambda it: f"{it['รหัส']} — {it['รายการวัตถุดิบ']}",
+                              container=fc3, include_all=True)
+    filter_item_code = filter_item["รหัส"] if filter_item else None
 
     st.markdown("---")
 
-    # ── Transaction list ──
-    transactions = db.get_transactions(
+    # ── Summary (aggregated server-side, cached per filter) ──
+    summary = db.get_transaction_summary(
         date_filter=filter_date,
         tx_type=filter_tx_type,
         item_code=filter_item_code,
     )
 
-    if transactions:
-        total_in = sum(t["จำนวน"] for t in transactions if t["ประเภท"] == "รับเข้า")
-        total_out = sum(t["จำนวน"] for t in transactions if t["ประเภท"] == "จ่ายออก")
-
+    if summary["count"]:
         sc1, sc2, sc3 = st.columns(3)
-        sc1.metric("📝 รายการทั้งหมด", len(transactions))
-        sc2.metric("➕ รับเข้า", f"{total_in:.1f}")
-        sc3.metric("🔻 จ่ายออก", f"{total_out:.1f}")
+        sc1.metric("📝 รายการทั้งหมด", summary["count"])
+        sc2.metric("➕ รับเข้า", f"{summary['total_in']:.1f}")
+        sc3.metric("🔻 จ่ายออก", f"{summary['total_out']:.1f}")
+
+        bc1, bc2 = st.columns(2)
+        with bc1.expander("📦 สรุปตามสินค้า"):
+            st.dataframe(summary["by_item"], use_container_width=True, hide_index=True)
+        with bc2.expander("👤 สรุปตามผู้ทำรายการ"):
+            by_req = summary["by_requester"].rename(columns={"requestner": "ผู้ทำรายการ"})
+            st.dataframe(by_req, use_container_width=True, hide_index=True)
 
         st.markdown("---")
 
-        df = pd.DataFrame(transactions)
+        # ── Sort + pagination ──
+        sort_labels = {
+            "row_num": "ลำดับที่บันทึก", "วันที่": "วันที่", "Order": "Order", "รหัส": "รหัส",
+            "ประเภท": "ประเภท", "จำนวน": "จำนวน", "requestner": "ผู้ทำรายการ",
+        }
+        pc1, pc2, pc3, pc4 = st.columns([3, 2, 2, 2])
+        sort_by = pc1.selectbox("↕️ เรียงตาม", db.TX_SORT_COLUMNS, format_func=sort_labels.get)
+        ascending = pc2.radio("ลำดับ", ["มาก → น้อย", "น้อย → มาก"], horizontal=True) == "น้อย → มาก"
+        page_size = pc3.selectbox("ต่อหน้า", [25, 50, 100, 200], index=1)
+        n_pages = max(1, -(-summary["count"] // page_size))
+        page_no = pc4.number_input(f"หน้า (จาก {n_pages})", min_value=1, max_value=n_pages, value=1, step=1)
+
+        df, total = db.query_transactions(
+            date_filter=filter_date,
+            tx_type=filter_tx_type,
+            item_code=filter_item_code,
+            sort_by=sort_by,
+            ascending=ascending,
+            page=int(page_no),
+            page_size=page_size,
+        )
         display_cols = ["Approve", "Order", "วันที่", "รหัส", "รายการ", "ประเภท", "จำนวน", "อายุ", "life", "เวลาเหลือ", "requestner"]
-        df = df[[c for c in display_cols if c in df.columns]]
+        df = df[display_cols]
         df.columns = ["อนุมัติ", "Order", "วันที่", "รหัส", "รายการ", "ประเภท", "จำนวน", "อายุ(วัน)", "หมดอายุ", "เหลือ(วัน)", "ผู้ทำรายการ"]
 
         st.dataframe(df, use_container_width=True, hide_index=True)
-    else:
+        first = (int(page_no) - 1) * page_size + 1
+        st.caption(f"แสดง {first:,}–{first + len(df) - 1:,} จาก {total:,} รายการ")
+    elif filter_date:
         st.info(f"ไม่พบรายการในวันที่ {filter_date.strftime('%d/%m/%Y')}")
+    else:
+        st.info("ไม่พบรายการ")
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  PAGE 6 : แนะนำการสั่ง (Suggested Orders)
+# ═══════════════════════════════════════════════════════════════════════════
+
+elif page == "🛒 แนะนำการสั่ง":
+    st.markdown('<p class="page-header">🛒 แนะนำการสั่ง</p>', unsafe_allow_html=True)
+    st.markdown('<p class="page-subheader">คาดการณ์การใช้วัตถุดิบจากประวัติจ่ายออก และปริมาณที่ควรสั่ง</p>', unsafe_allow_html=True)
+
+    pc1, pc2, pc3 = st.columns(3)
+    window_days = pc1.slider("📆 เฉลี่ยการใช้ย้อนหลัง (วัน)", 3, 60, forecast.USAGE_WINDOW_DAYS)
+    lead_time = pc2.slider("🚚 ระยะเวลารอของ (วัน)", 0, 14, forecast.LEAD_TIME_DAYS)
+    cover_days = pc3.slider("📦 สั่งให้พอใช้ (วัน)", 1, 30, forecast.COVER_DAYS)
+
+    suggestions = forecast.get_reorder_suggestions(window_days, lead_time, cover_days)
+
+    if suggestions.empty:
+        st.info("ยังไม่มีสินค้าในระบบ กรุณาเพิ่มที่เมนู **📦 จัดการ Stock**")
+    else:
+        to_order = suggestions[suggestions["แนะนำสั่ง"] > 0]
+        mc1, mc2, mc3 = st.columns(3)
+        mc1.metric("🔴 สั่งด่วน", int((suggestions["สถานะ"] == forecast.FORECAST_URGENT).sum()))
+        mc2.metric("🛒 รายการที่ควรสั่ง", len(to_order))
+        mc3.metric("💰 มูลค่าที่ควรสั่ง", f"฿{to_order['มูลค่าสั่ง'].sum():,.0f}")
+
+        st.markdown("---")
+
+        show_all = st.checkbox("แสดงทุกรายการ", value=False)
+        table = suggestions if show_all else to_order
+        st.dataframe(
+            table[["สถานะ", "รหัส", "รายการวัตถุดิบ", "หน่วยนับ", "คงเหลือจริง", "สต็อกขั้นต่ำ",
+                   "ใช้เฉลี่ย/วัน", "แนวโน้ม", "เหลืออีก (วัน)", "คาดว่าหมด", "อายุการเก็บ (วัน)",
+                   "แนะนำสั่ง", "มูลค่าสั่ง"]],
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "รายการวัตถุดิบ": st.column_config.TextColumn("รายการ"),
+                "คงเหลือจริง": st.column_config.NumberColumn("คงเหลือ", format="%.1f"),
+                "สต็อกขั้นต่ำ": st.column_config.NumberColumn("ขั้นต่ำ", format="%.1f"),
+                "ใช้เฉลี่ย/วัน": st.column_config.NumberColumn(format="%.2f"),
+                "แนวโน้ม": st.column_config.NumberColumn(format="%+.2f"),
+                "เหลืออีก (วัน)": st.column_config.NumberColumn(format="%.1f"),
+                "คาดว่าหมด": st.column_config.DateColumn(format="DD/MM/YYYY"),
+                "แนะนำสั่ง": st.column_config.NumberColumn(format="%.1f"),
+                "มูลค่าสั่ง": st.column_config.NumberColumn(format="฿%.0f"),
+            },
+        )
+        st.caption("ใช้เฉลี่ย/วัน คำนวณจากรายการจ่ายออกที่อนุมัติแล้ว • ปริมาณแนะนำไม่เกินที่ใช้ได้ภายในอายุการเก็บ")
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  PAGE 7 : นำเข้า / ส่งออก (Bulk Import / Export)
+# ═══════════════════════════════════════════════════════════════════════════
+
+elif page == "📥 นำเข้า / ส่งออก":
+    st.markdown('<p class="page-header">📥 นำเข้า / ส่งออก</p>', unsafe_allow_html=True)
+    st.markdown('<p class="page-subheader">นำเข้าข้อมูลจำนวนมากจากไฟล์ CSV / Parquet และส่งออกข้อมูลทั้งหมด</p>', unsafe_allow_html=True)
+
+    # ── Import ──
+    st.markdown("### 📥 นำเข้าข้อมูล")
+    kind = st.radio("ประเภทข้อมูล", ["รายการสินค้า", "Transactions (RP-PO)"], horizontal=True)
+    is_items = kind == "รายการสินค้า"
+
+    with st.expander("📄 รูปแบบไฟล์"):
+        if is_items:
+            st.markdown(
+                "คอลัมน์ที่ต้องมี: **รายการวัตถุดิบ, หมวดหมู่, หน่วยนับ**  \n"
+                "ไม่บังคับ: ราคา/หน่วย, สต็อกขั้นต่ำ, คงเหลือจริง, อายุการเก็บ (วัน)  \n"
+                "รหัสสินค้าจะถูกสร้างอัตโนมัติจากหมวดหมู่"
+            )
+        else:
+            st.markdown(
+                "คอลัมน์ที่ต้องมี: **วันที่, รหัส, ประเภท (รับเข้า/จ่ายออก), จำนวน**  \n"
+                "ไม่บังคับ: requestner, Approve (TRUE/FALSE, ค่าเริ่มต้น TRUE)  \n"
+                "ชื่อรายการและอายุการเก็บจะดึงจากรายการสินค้าตามรหัส"
+            )
+
+    uploaded = st.file_uploader("เลือกไฟล์ CSV หรือ Parquet", type=["csv", "parquet"])
+    if uploaded:
+        try:
+            raw = db.read_import_file(uploaded, uploaded.name)
+        except Exception as e:
+            st.error(f"❌ อ่านไฟล์ไม่ได้: {e}")
+            st.stop()
+
+        validate = db.validate_items_import if is_items else db.validate_tx_import
+        clean, errors = validate(raw)
+
+        if errors:
+            st.error(f"❌ พบข้อผิดพลาด {len(errors)} รายการ (แสดงสูงสุด 20 แถวต่อประเภท)")
+            st.markdown("\n".join(f"- {e}" for e in errors))
+        else:
+            st.success(f"✅ ตรวจสอบผ่าน {len(clean):,} แถว")
+            st.dataframe(clean.head(20), use_container_width=True, hide_index=True)
+
+            job_key = f"import:{db.get_current_branch()}:{kind}:{uploaded.name}:{uploaded.size}"
+            done = st.session_state.get(job_key, 0)
+            if done >= len(clean):
+                st.success("✅ ไฟล์นี้นำเข้าครบแล้ว")
+            else:
+                if done:
+                    st.info(f"นำเข้าแล้ว {done:,}/{len(clean):,} แถว — กดปุ่มเพื่อทำต่อจากจุดเดิม")
+                if st.button("⏯️ นำเข้าต่อ" if done else "▶️ เริ่มนำเข้า", use_container_width=True):
+                    bar = st.progress(done / len(clean), text=f"{done:,}/{len(clean):,}")
+
+                    def on_progress(n, total):
+                        st.session_state[job_key] = n
+                        bar.progress(n / total, text=f"{n:,}/{total:,}")
+
+                    importer = db.import_items if is_items else db.import_transactions
+                    try:
+                        importer(clean, start=done, progress=on_progress)
+                        st.session_state[job_key] = len(clean)
+                        st.success(f"✅ นำเข้า {len(clean):,} แถวสำเร็จ!")
+                    except Exception as e:
+                        st.error(
+                            f"❌ หยุดที่แถว {st.session_state.get(job_key, done):,}: {e} "
+                            f"— กดนำเข้าต่อเพื่อทำต่อจากจุดเดิม"
+                        )
+
+    st.markdown("---")
+
+    # ── Export ──
+    st.markdown("### 📤 ส่งออกข้อมูล (Parquet)")
+    branch = db.get_current_branch()
+    stamp = db.thai_today().strftime("%Y%m%d")
+    xc1, xc2 = st.columns(2)
+    if xc1.button("📦 เตรียมไฟล์รายการสินค้า", use_container_width=True):
+        st.session_state[f"export_items:{branch}"] = db.export_items_parquet()
+    if f"export_items:{branch}" in st.session_state:
+        xc1.download_button("⬇️ ดาวน์โหลดรายการสินค้า", st.session_state[f"export_items:{branch}"],
+                            file_name=f"items_{branch}_{stamp}.parquet", use_container_width=True)
+    if xc2.button("📋 เตรียมไฟล์ Transactions", use_container_width=True):
+        st.session_state[f"export_tx:{branch}"] = db.export_transactions_parquet()
+    if f"export_tx:{branch}" in st.session_state:
+        xc2.download_button("⬇️ ดาวน์โหลด Transactions", st.session_state[f"export_tx:{branch}"],
+                            file_name=f"transactions_{branch}_{stamp}.parquet", use_container_width=True)
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  PAGE 8 : ภาพรวมทุกสาขา (Multi-branch Overview)
+# ═══════════════════════════════════════════════════════════════════════════
+
+elif page == "🏢 ภาพรวมทุกสาขา":
+    st.markdown('<p class="page-header">🏢 ภาพรวมทุกสาขา</p>', unsafe_allow_html=True)
+    st.markdown('<p class="page-subheader">สต็อกและรายการที่ต้องเติมรวมทุกสาขา</p>', unsafe_allow_html=True)
+
+    all_items, branch_errors = db.get_consolidated_items(BRANCHES)
+    for name, err in branch_errors.items():
+        st.error(f"❌ โหลดข้อมูลสาขา {name} ไม่ได้: {err}")
+
+    if all_items.empty:
+        st.info("ยังไม่มีข้อมูลสินค้า")
+    else:
+        per_branch = db.summarize_branches(all_items)
+        mc1, mc2, mc3 = st.columns(3)
+        mc1.metric("🏢 สาขา", len(per_branch))
+        mc2.metric("⚠️ ต่ำกว่ามาตรฐาน (ทุกสาขา)", int(per_branch["ต่ำกว่ามาตรฐาน"].sum()))
+        mc3.metric("💰 มูลค่ารวม", f"฿{per_branch['มูลค่ารวม'].sum():,.0f}")
+
+        st.markdown("---")
+        st.markdown("### 🏢 สรุปรายสาขา")
+        st.dataframe(
+            per_branch,
+            use_container_width=True,
+            hide_index=True,
+            column_config={"มูลค่ารวม": st.column_config.NumberColumn(format="฿%.0f")},
+        )
+
+        st.markdown("### 📦 สต็อกรวมรายสินค้า")
+        only_needed = st.checkbox("แสดงเฉพาะรายการที่ต้องเติม", value=True)
+        combined = db.consolidate_stock(all_items)
+        if only_needed:
+            combined = combined[combined["ต้องเติมรวม"] > 0]
+        st.dataframe(
+            combined,
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "รายการวัตถุดิบ": st.column_config.TextColumn("รายการ"),
+                "คงเหลือรวม": st.column_config.NumberColumn(format="%.1f"),
+                "ขั้นต่ำรวม": st.column_config.NumberColumn(format="%.1f"),
+                "ต้องเติมรวม": st.column_config.NumberColumn(format="%.1f"),
+                "มูลค่ารวม": st.column_config.NumberColumn(format="฿%.0f"),
+            },
+        )
+
+        with st.expander("📋 รายการที่ต้องเติมแยกตามสาขา"):
+            needs = all_items[all_items["need_to_restock"] > 0]
+            st.dataframe(
+                needs[["สาขา", "รหัส", "รายการวัตถุดิบ", "หน่วยนับ", "คงเหลือจริง", "สต็อกขั้นต่ำ", "need_to_restock"]],
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    "คงเหลือจริง": st.column_config.NumberColumn("คงเหลือ", format="%.1f"),
+                    "สต็อกขั้นต่ำ": st.column_config.NumberColumn("ขั้นต่ำ", format="%.1f"),
+                    "need_to_restock": st.column_config.NumberColumn("ต้องเติม", format="%.1f"),
+                },
+            )
+
+
+# ─── Sidebar: sync status ────────────────────────────────────────────────────
+
+sync_ages = [age for age in db.get_sync_status().values() if age is not None]
+sync_text = (
+    f"ซิงค์ล่าสุด {max(sync_ages):.0f} วินาทีที่แล้ว" if sync_ages else "ยังไม่ได้โหลดข้อมูล"
+)
+sync_note.markdown(
+    f"<p style='font-size:0.7rem;color:#64748b;text-align:center;'>"
+    f"{sync_text}<br>กด Refresh เพื่ออัพเดทล่าสุด</p>",
+    unsafe_allow_html=True,
+)
@@ -1,17 +1,26 @@
 """
 Database layer using Google Sheets via gspread.
-Sheets:
+Sheets (one spreadsheet per branch):
   - รายการสินค้า: items master data
   - RP-PO: transactions (รับเข้า / จ่ายออก)
 
-Uses st.cache_data to minimize Google Sheets API calls (limit: 300/min).
+Sheet reads are held in warm per-branch snapshots, refreshed ahead of expiry by a
+background thread, to minimize Google Sheets API calls (limit: 300/min).
 """
 
 import streamlit as st
 import gspread
+import numpy as np
+import pandas as pd
 from google.oauth2.service_account import Credentials
 from datetime import datetime, date, timedelta
 from zoneinfo import ZoneInfo
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import bisect
+import io
+import threading
 import time
 
 # ─── Timezone ────────────────────────────────────────────────────────────────
@@ -58,58 +67,97 @@ def get_gspread_client():
     return gspread.authorize(creds)
 
 
+# ─── Branches ────────────────────────────────────────────────────────────────
+#
+# Each restaurant branch has its own copy of the spreadsheet. Configure them in
+# secrets as a table under [google_sheets.branches] (name = "url"); without it
+# the single google_sheets.spreadsheet_url is used as one branch.
+
+DEFAULT_BRANCH = "หลัก"
+
+
+def get_branches() -> dict[str, str]:
+    """Return branch name → spreadsheet URL from secrets."""
+    cfg = st.secrets["google_sheets"]
+    if "branches" in cfg:
+        return dict(cfg["branches"])
+    return {DEFAULT_BRANCH: cfg["spreadsheet_url"]}
+
+
+def get_current_branch() -> str:
+    """Branch selected in this session (first configured branch by default)."""
+    branches = get_branches()
+    name = st.session_state.get("branch")
+    return name if name in branches else next(iter(branches))
+
+
+def _resolve_branch(branch: str | None) -> str:
+    return branch if branch is not None else get_current_branch()
+
+
 @st.cache_resource(ttl=600)
-def _get_spreadsheet_cached():
+def _get_spreadsheet_cached(branch: str):
     """Cache the spreadsheet object to avoid repeated open_by_url calls."""
     client = get_gspread_client()
-    url = st.secrets["google_sheets"]["spreadsheet_url"]
-    return client.open_by_url(url)
+    return client.open_by_url(get_branches()[branch])
 
 
-def get_spreadsheet():
-    """Get the spreadsheet object (cached)."""
-    return _get_spreadsheet_cached()
+def get_spreadsheet(branch: str | None = None):
+    """Get the spreadsheet object for a branch (cached)."""
+    return _get_spreadsheet_cached(_resolve_branch(branch))
 
 
-def get_items_sheet():
+def get_items_sheet(branch: str | None = None):
     """Get the items worksheet."""
-    return get_spreadsheet().worksheet(ITEMS_SHEET)
+    return get_spreadsheet(branch).worksheet(ITEMS_SHEET)
 
 
-def get_tx_sheet():
+def get_tx_sheet(branch: str | None = None):
     """Get the transactions worksheet."""
-    return get_spreadsheet().worksheet(TX_SHEET)
+    return get_spreadsheet(branch).worksheet(TX_SHEET)
 
 
 # ─── Cache Management ───────────────────────────────────────────────────────
+#
+# Sheet downloads live in per-branch snapshots (see Warm Snapshots below), so
+# refreshing one branch leaves the others warm. Derived caches are keyed by
+# snapshot version and follow a new snapshot without being cleared.
 
 
-def clear_items_cache():
+def clear_items_cache(branch: str | None = None):
     """Clear the items data cache after a write operation."""
-    _fetch_items_data.clear()
-    _fetch_restock_data.clear()
+    _invalidate_snapshot("items", _resolve_branch(branch))
 
 
-def clear_tx_cache():
+def clear_tx_cache(branch: str | None = None):
     """Clear the transactions data cache after a write operation."""
-    _fetch_tx_data.clear()
+    _invalidate_snapshot("tx", _resolve_branch(branch))
+
 
+def clear_all_cache(branch: str | None = None):
+    """Clear all data caches for a branch."""
+    clear_items_cache(branch)
+    clear_tx_cache(branch)
 
-def clear_all_cache():
-    """Clear all data caches."""
-    clear_items_cache()
-    clear_tx_cache()
+
+def clear_materialized(branch: str | None = None):
+    """Drop materialized aggregates so they are rebuilt from the sheet on next read."""
+    branch = _resolve_branch(branch)
+    _daily_movement_store.clear(branch)
+    _lot_store.clear(branch)
+    _item_row_store.clear(branch)
 
 
 # ─── Init (ensure headers) ──────────────────────────────────────────────────
 
 
-def init_db():
-    """Ensure sheets exist with proper headers. Called once on app start."""
-    if "db_initialized" in st.session_state:
+def init_db(branch: str | None = None):
+    """Ensure sheets exist with proper headers. Called once per branch on app start."""
+    branch = _resolve_branch(branch)
+    if f"db_initialized:{branch}" in st.session_state:
         return  # Already initialized this session
     try:
-        sp = get_spreadsheet()
+        sp = get_spreadsheet(branch)
 
         # Items sheet
         try:
@@ -129,7 +177,7 @@ def init_db():
             ws = sp.add_worksheet(title=TX_SHEET, rows=1000, cols=len(TX_HEADERS))
             ws.update("A1", [TX_HEADERS])
 
-        st.session_state["db_initialized"] = True
+        st.session_state[f"db_initialized:{branch}"] = True
 
     except Exception as e:
         st.error(f"❌ ไม่สามารถเชื่อมต่อ Google Sheets ได้: {e}")
@@ -155,11 +203,37 @@ def _safe_int(val, default=0):
 
 # ─── Retry wrapper ───────────────────────────────────────────────────────────
 
+SHEETS_QUOTA_PER_MIN = 300  # Google Sheets API requests per minute
+
+
+@st.cache_resource
+def _quota_tracker() -> dict:
+    """Process-level sliding window of API call timestamps (last 60 s)."""
+    return {"calls": deque(), "lock": threading.Lock()}
+
+
+def _note_api_call():
+    tracker = _quota_tracker()
+    now = time.monotonic()
+    with tracker["lock"]:
+        tracker["calls"].append(now)
+        while tracker["calls"] and now - tracker["calls"][0] > 60:
+            tracker["calls"].popleft()
+
+
+def api_calls_last_minute() -> int:
+    """Number of Sheets API calls made by this process in the last 60 seconds."""
+    tracker = _quota_tracker()
+    now = time.monotonic()
+    with tracker["lock"]:
+        return sum(1 for t in tracker["calls"] if now - t <= 60)
+
 
 def _retry_api_call(func, max_retries=3, delay=2):
     """Retry an API call with exponential backoff on 429 errors."""
     for attempt in range(max_retries):
         try:
+            _note_api_call()
             return func()
         except gspread.exceptions.APIError as e:
             if e.response.status_code == 429 and attempt < max_retries - 1:
@@ -170,13 +244,51 @@ def _retry_api_call(func, max_retries=3, delay=2):
     return None
 
 
-# ─── Cached Data Fetchers (1 API call each, cached for CACHE_TTL) ───────────
+# ─── Async Sheets I/O ────────────────────────────────────────────────────────
+#
+# gspread is a blocking client, so the async layer runs each call on a worker
+# thread of one process-wide event loop. All workers share the client's pooled
+# HTTP session (keep-alive), and independent calls are awaited together with
+# asyncio.gather. Page code keeps calling the sync functions; they hand their
+# coroutines to the loop through _run_async.
 
+SHEETS_IO_WORKERS = 8  # below the HTTP session's default connection pool size (10)
 
-@st.cache_data(ttl=CACHE_TTL)
-def _fetch_items_data() -> list[dict]:
-    """Fetch all items from Google Sheets — CACHED."""
-    ws = get_items_sheet()
+
+@st.cache_resource
+def _io_loop() -> asyncio.AbstractEventLoop:
+    """Start the process-wide I/O event loop on a daemon thread (once)."""
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(SHEETS_IO_WORKERS, thread_name_prefix="sheets-io"))
+    threading.Thread(target=loop.run_forever, name="sheets-io-loop", daemon=True).start()
+    return loop
+
+
+def _run_async(coro):
+    """Sync facade: run a coroutine on the I/O loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, _io_loop()).result()
+
+
+async def _aretry_api_call(func, max_retries=3, delay=2):
+    """Async _retry_api_call: the call runs on a worker, backoff waits without blocking one."""
+    for attempt in range(max_retries):
+        try:
+            _note_api_call()
+            return await asyncio.to_thread(func)
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code == 429 and attempt < max_retries - 1:
+                await asyncio.sleep(delay * (2 ** attempt))
+            else:
+                raise
+    return None
+
+
+# ─── Sheet Loaders (1 API call each, uncached — see Warm Snapshots) ─────────
+
+
+def _load_items_data(branch: str) -> list[dict]:
+    """Fetch all items of a branch from Google Sheets."""
+    ws = get_items_sheet(branch)
     records = _retry_api_call(lambda: ws.get_all_records())
     items = []
     for i, row in enumerate(records):
@@ -199,21 +311,25 @@ def _fetch_items_data() -> list[dict]:
     return items
 
 
-@st.cache_data(ttl=CACHE_TTL)
-def _fetch_tx_data() -> list[dict]:
+def _load_tx_data(branch: str) -> list[dict]:
     """
-    Fetch all transactions from Google Sheets — CACHED.
+    Fetch all transactions of a branch from Google Sheets.
     Uses get_all_values() + column-index mapping instead of get_all_records()
     to avoid header-name mismatch issues.
     """
-    ws = get_tx_sheet()
-    all_rows = _retry_api_call(lambda: ws.get_all_values())
+    ws = get_tx_sheet(branch)
+    return _parse_tx_rows(_retry_api_call(lambda: ws.get_all_values()))
+
+
+def _parse_tx_rows(all_rows: list[list]) -> list[dict]:
+    """Turn raw RP-PO values (header row included) into transaction dicts."""
     if not all_rows or len(all_rows) < 2:
         return []
 
     # Column index mapping (0-based):
     # A=0:Approve, B=1:Order, C=2:วันที่, D=3:รหัส, E=4:รายการ,
     # F=5:ประเภท, G=6:จำนวน, H=7:อายุ, I=8:life, J=9:เวลาเหลือ, K=10:requestner
+    today = thai_today()
     txs = []
     for i, row in enumerate(all_rows[1:]):  # skip header
         # Pad row to 11 columns if shorter
@@ -230,6 +346,7 @@ def _fetch_tx_data() -> list[dict]:
         # Skip example rows
         if item_name == "ตัวอย่าง":
             continue
+        life_date = _parse_tx_date(row[8])
 
         txs.append({
             "row_num": i + 2,
@@ -242,51 +359,233 @@ def _fetch_tx_data() -> list[dict]:
             "จำนวน": _safe_float(row[6]),
             "อายุ": _safe_int(row[7]),
             "life": str(row[8]).strip(),
-            "เวลาเหลือ": _safe_int(row[9]),
+            # Remaining days are derived from the expiry date at read time —
+            # the sheet value is only correct on the day the row was written.
+            "เวลาเหลือ": (life_date - today).days if life_date else _safe_int(row[9]),
             "requestner": str(row[10]).strip(),
         })
     return txs
 
 
-@st.cache_data(ttl=CACHE_TTL)
-def _fetch_restock_data() -> list[dict]:
-    """Fetch restock report — CACHED (reuses items cache internally)."""
-    items = _fetch_items_data()
-    return [
-        {
-            **item,
-            "need_to_restock": item["สต็อกขั้นต่ำ"] - item["คงเหลือจริง"],
+# ─── Warm Snapshots (atomic swap, refreshed ahead of expiry) ────────────────
+#
+# Each (dataset, branch) is held as one immutable snapshot. Readers get the
+# current snapshot; a refresh loads the sheet outside the lock and swaps the
+# new snapshot in with a single dict assignment. Every invalidation bumps a
+# per-key epoch, and a load that straddles one is thrown away, so rows read
+# before a write never come back stamped as fresh. A background thread
+# (start_background_refresher) keeps recently read snapshots warm, so page
+# reruns normally never wait on the Sheets API.
+
+PREFETCH_LEAD = 15          # seconds before expiry that the refresher reloads
+PREFETCH_IDLE = 600         # stop refreshing datasets nobody has read for this long
+PREFETCH_TICK = 5           # seconds between refresher passes
+PREFETCH_QUOTA_SHARE = 0.3  # prefetch only while API use is below this share of quota
+
+_LOADERS = {"items": _load_items_data, "tx": _load_tx_data}
+
+
+@st.cache_resource
+def _version_counter() -> dict:
+    """Process-wide counter behind every data version (never reset by cache clears)."""
+    return {"value": 0, "lock": threading.Lock()}
+
+
+def _next_version() -> int:
+    """Next data version — unique for the life of the process, so safe as a cache key."""
+    counter = _version_counter()
+    with counter["lock"]:
+        counter["value"] += 1
+        return counter["value"]
+
+
+@st.cache_resource
+def _snapshot_store() -> dict:
+    """Process-level snapshots: (dataset, branch) → {rows, fetched_at, version, last_read}."""
+    return {"data": {}, "epochs": {}, "lock": threading.Lock(), "loading": {}}
+
+
+def _loading_lock(kind: str, branch: str) -> threading.Lock:
+    """Per-dataset lock held while loading, so one load runs at a time."""
+    store = _snapshot_store()
+    with store["lock"]:
+        return store["loading"].setdefault((kind, branch), threading.Lock())
+
+
+def _refresh_snapshot(kind: str, branch: str) -> dict | None:
+    """
+    Load a dataset from the sheet and swap it in atomically.
+    Returns None, keeping nothing, if the dataset was invalidated mid-load.
+    """
+    store = _snapshot_store()
+    with store["lock"]:
+        epoch = store["epochs"].get((kind, branch), 0)
+    rows = _LOADERS[kind](branch)
+    with store["lock"]:
+        if store["epochs"].get((kind, branch), 0) != epoch:
+            return None  # a write landed while loading — these rows may predate it
+        previous = store["data"].get((kind, branch))
+        if previous is not None and previous["rows"] == rows:
+            rows, version = previous["rows"], previous["version"]  # unchanged — derived caches stay valid
+        else:
+            version = _next_version()
+        snap = {
+            "rows": rows,
+            "fetched_at": time.time(),
+            "version": version,
+            "last_read": previous["last_read"] if previous else time.time(),
         }
-        for item in items
-        if item["คงเหลือจริง"] < item["สต็อกขั้นต่ำ"]
-    ]
+        store["data"][(kind, branch)] = snap
+    return snap
+
+
+def _load_until_current(kind: str, branch: str) -> dict:
+    """Refresh until a load completes with no write in between. Caller holds the loading lock."""
+    snap = None
+    while snap is None:
+        snap = _refresh_snapshot(kind, branch)
+    return snap
+
+
+def _reload_snapshot(kind: str, branch: str) -> dict:
+    """Reload a dataset now (e.g. right after a write)."""
+    with _loading_lock(kind, branch):
+        return _load_until_current(kind, branch)
+
+
+def _get_snapshot(kind: str, branch: str) -> dict:
+    """Current snapshot, loading synchronously only if it is missing or expired."""
+    store = _snapshot_store()
+    snap = store["data"].get((kind, branch))
+    if snap is None or time.time() - snap["fetched_at"] > CACHE_TTL:
+        with _loading_lock(kind, branch):  # one loader per dataset; others wait and reuse its result
+            snap = store["data"].get((kind, branch))
+            if snap is None or time.time() - snap["fetched_at"] > CACHE_TTL:
+                snap = _load_until_current(kind, branch)
+    snap["last_read"] = time.time()
+    return snap
+
+
+def _invalidate_snapshot(kind: str, branch: str):
+    """Drop a snapshot after a write so the next read fetches fresh data."""
+    store = _snapshot_store()
+    with store["lock"]:
+        store["data"].pop((kind, branch), None)
+        store["epochs"][(kind, branch)] = store["epochs"].get((kind, branch), 0) + 1
+
+
+def _snapshot_version(kind: str, branch: str) -> int:
+    return _get_snapshot(kind, branch)["version"]
+
+
+def _fetch_items_data(branch: str) -> list[dict]:
+    """All items of a branch from the warm snapshot (shared — treat as read-only)."""
+    return _get_snapshot("items", branch)["rows"]
+
+
+def _fetch_tx_data(branch: str) -> list[dict]:
+    """All transactions of a branch from the warm snapshot (shared — treat as read-only)."""
+    return _get_snapshot("tx", branch)["rows"]
+
+
+def _refresher_loop():
+    """Reload snapshots that are about to expire, within the prefetch quota share."""
+    store = _snapshot_store()
+    budget = SHEETS_QUOTA_PER_MIN * PREFETCH_QUOTA_SHARE
+    while True:
+        time.sleep(PREFETCH_TICK)
+        now = time.time()
+        for key, snap in list(store["data"].items()):
+            if now - snap["last_read"] > PREFETCH_IDLE:
+                continue
+            if now - snap["fetched_at"] < CACHE_TTL - PREFETCH_LEAD:
+                continue
+            if api_calls_last_minute() >= budget:
+                break  # leave the remaining quota to user actions
+            loading = _loading_lock(*key)
+            if not loading.acquire(blocking=False):
+                continue  # a reader is already loading it
+            try:
+                _refresh_snapshot(*key)
+            except Exception:
+                pass  # a failed (or discarded) prefetch just means the next read loads synchronously
+            finally:
+                loading.release()
+
+
+@st.cache_resource
+def start_background_refresher() -> threading.Thread:
+    """Start the process-wide prefetch thread once (safe to call every rerun)."""
+    thread = threading.Thread(target=_refresher_loop, name="sheets-prefetch", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_sync_status(branch: str | None = None) -> dict:
+    """Seconds since items / transactions of a branch were last loaded (None if never)."""
+    store = _snapshot_store()
+    branch = _resolve_branch(branch)
+    now = time.time()
+    return {
+        kind: (now - snap["fetched_at"]) if (snap := store["data"].get((kind, branch))) else None
+        for kind in _LOADERS
+    }
+
+
+# ─── Derived Caches (keyed by snapshot version) ─────────────────────────────
+
+
+STOCK_STATUS_LOW = "🔴 ต่ำกว่าขั้นต่ำ"
+STOCK_STATUS_NEAR = "🟡 ใกล้ขั้นต่ำ"
+STOCK_STATUS_OK = "🟢 ปกติ"
+
+ITEMS_FRAME_COLUMNS = ["row_num"] + ITEMS_HEADERS
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=32)
+def _fetch_items_frame(branch: str, version: int) -> pd.DataFrame:
+    """
+    Items as a DataFrame with precomputed stock-status columns — CACHED per snapshot version.
+    Status is one vectorized pass per data refresh:
+    below minimum / within 20% above minimum / ok.
+    """
+    df = pd.DataFrame(_fetch_items_data(branch), columns=ITEMS_FRAME_COLUMNS)
+    qty = df["คงเหลือจริง"].astype(float)
+    min_qty = df["สต็อกขั้นต่ำ"].astype(float)
+    df["สถานะสต็อก"] = np.select(
+        [qty < min_qty, qty < min_qty * 1.2],
+        [STOCK_STATUS_LOW, STOCK_STATUS_NEAR],
+        default=STOCK_STATUS_OK,
+    )
+    df["need_to_restock"] = (min_qty - qty).clip(lower=0)
+    return df
 
 
 # ─── Public Read Functions (use cache) ──────────────────────────────────────
 
 
-def get_all_items() -> list[dict]:
+def get_all_items(branch: str | None = None) -> list[dict]:
     """Return all items (cached)."""
-    return _fetch_items_data()
+    return _fetch_items_data(_resolve_branch(branch))
 
 
-def get_item_by_code(code: str) -> dict | None:
+def get_item_by_code(code: str, branch: str | None = None) -> dict | None:
     """Find an item by its code (uses cache)."""
-    for item in get_all_items():
+    for item in get_all_items(branch):
         if item["รหัส"] == code:
             return item
     return None
 
 
-def get_all_transactions() -> list[dict]:
+def get_all_transactions(branch: str | None = None) -> list[dict]:
     """Return all transactions (cached)."""
-    return _fetch_tx_data()
+    return _fetch_tx_data(_resolve_branch(branch))
 
 
 def get_transactions(date_filter: date | None = None, tx_type: str | None = None,
-                     item_code: str | None = None) -> list[dict]:
+                     item_code: str | None = None, branch: str | None = None) -> list[dict]:
     """Get transactions with optional filters (uses cache)."""
-    txs = get_all_transactions()
+    txs = get_all_transactions(branch)
 
     if date_filter:
         date_str = date_filter.strftime("%d/%m/%y")
@@ -301,16 +600,431 @@ def get_transactions(date_filter: date | None = None, tx_type: str | None = None
     return txs
 
 
-def get_today_transaction_count() -> int:
+def get_today_transaction_count(branch: str | None = None) -> int:
     """Count today's transactions (uses cache)."""
     today_str = thai_today().strftime("%d/%m/%y")
-    txs = get_all_transactions()
+    txs = get_all_transactions(branch)
     return sum(1 for t in txs if t["วันที่"] == today_str)
 
 
-def get_restock_report() -> list[dict]:
-    """Return items below minimum stock (cached)."""
-    return _fetch_restock_data()
+def get_items_frame(branch: str | None = None) -> pd.DataFrame:
+    """Return items as a DataFrame with stock-status columns (cached)."""
+    branch = _resolve_branch(branch)
+    return _fetch_items_frame(branch, _snapshot_version("items", branch))
+
+
+# ─── Transactions Explorer (indexed, server-side paging) ────────────────────
+
+TX_COLUMNS = [
+    "row_num", "Approve", "Order", "วันที่", "รหัส", "รายการ",
+    "ประเภท", "จำนวน", "อายุ", "life", "เวลาเหลือ", "requestner",
+]
+
+TX_SORT_COLUMNS = ["row_num", "วันที่", "Order", "รหัส", "ประเภท", "จำนวน", "requestner"]
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=16)
+def _build_tx_index(branch: str, version: int) -> dict:
+    """
+    Build an indexed DataFrame over all transactions — CACHED (shared, read-only).
+    Row positions are pre-grouped by date / type / item code so filtering is
+    a dict lookup plus an array intersection instead of a Python list scan.
+    """
+    df = pd.DataFrame(_fetch_tx_data(branch), columns=TX_COLUMNS)
+    df["_date"] = pd.to_datetime(df["วันที่"], format="%d/%m/%y", errors="coerce")
+    return {
+        "df": df,
+        "by_date": df.groupby("วันที่", sort=False).indices,
+        "by_type": df.groupby("ประเภท", sort=False).indices,
+        "by_code": df.groupby("รหัส", sort=False).indices,
+    }
+
+
+def _filter_tx_positions(index: dict, date_filter: date | None,
+                         tx_type: str | None, item_code: str | None) -> np.ndarray:
+    """Return sorted row positions matching all given filters."""
+    positions = None
+    lookups = [
+        ("by_date", date_filter.strftime("%d/%m/%y") if date_filter else None),
+        ("by_type", tx_type),
+        ("by_code", item_code),
+    ]
+    for key, value in lookups:
+        if not value:
+            continue
+        hit = index[key].get(value, np.empty(0, dtype=np.intp))
+        positions = hit if positions is None else np.intersect1d(positions, hit, assume_unique=True)
+    if positions is None:
+        return np.arange(len(index["df"]))
+    return np.sort(positions)
+
+
+@st.cache_data(ttl=CACHE_TTL)
+def _sorted_tx_positions(branch: str, version: int, date_filter: date | None, tx_type: str | None,
+                         item_code: str | None, sort_by: str, ascending: bool) -> np.ndarray:
+    """Filtered + sorted row positions — CACHED per snapshot version and filter/sort key."""
+    index = _build_tx_index(branch, version)
+    positions = _filter_tx_positions(index, date_filter, tx_type, item_code)
+    if sort_by == "row_num":
+        return positions if ascending else positions[::-1]
+    sort_col = "_date" if sort_by == "วันที่" else sort_by
+    keys = index["df"][sort_col].to_numpy()[positions]
+    order = pd.Series(keys).sort_values(ascending=ascending, kind="stable").index.to_numpy()
+    return positions[order]
+
+
+@st.cache_data(ttl=CACHE_TTL)
+def _fetch_tx_summary(branch: str, version: int, date_filter: date | None, tx_type: str | None,
+                      item_code: str | None) -> dict:
+    """
+    Aggregate the filtered transactions — CACHED per snapshot version and filter key.
+    One groupby over (item, requester, type) feeds every total and breakdown.
+    """
+    index = _build_tx_index(branch, version)
+    df = index["df"].take(_filter_tx_positions(index, date_filter, tx_type, item_code))
+
+    grouped = (
+        df.groupby(["รหัส", "รายการ", "requestner", "ประเภท"], sort=False)["จำนวน"]
+        .agg(["size", "sum"])
+        .reset_index()
+    )
+
+    def breakdown(keys: list[str]) -> pd.DataFrame:
+        if grouped.empty:
+            return pd.DataFrame(columns=keys + ["รายการทั้งหมด", "รับเข้า", "จ่ายออก"])
+        qty = grouped.pivot_table(index=keys, columns="ประเภท", values="sum",
+                                  aggfunc="sum", fill_value=0.0)
+        qty = qty.reindex(columns=["รับเข้า", "จ่ายออก"], fill_value=0.0)
+        qty.columns.name = None
+        qty.insert(0, "รายการทั้งหมด", grouped.groupby(keys)["size"].sum())
+        return qty.sort_values("รายการทั้งหมด", ascending=False).reset_index()
+
+    by_type = grouped.groupby("ประเภท")["sum"].sum()
+    return {
+        "count": int(grouped["size"].sum()),
+        "total_in": float(by_type.get("รับเข้า", 0.0)),
+        "total_out": float(by_type.get("จ่ายออก", 0.0)),
+        "by_item": breakdown(["รหัส", "รายการ"]),
+        "by_requester": breakdown(["requestner"]),
+    }
+
+
+def query_transactions(date_filter: date | None = None, tx_type: str | None = None,
+                       item_code: str | None = None, sort_by: str = "row_num",
+                       ascending: bool = False, page: int = 1, page_size: int = 50,
+                       branch: str | None = None) -> tuple[pd.DataFrame, int]:
+    """
+    Return one page of filtered, sorted transactions plus the total match count.
+    Filtering, sorting and slicing all happen server-side over the cached index.
+    """
+    branch = _resolve_branch(branch)
+    if sort_by not in TX_SORT_COLUMNS:
+        sort_by = "row_num"
+    version = _snapshot_version("tx", branch)
+    positions = _sorted_tx_positions(branch, version, date_filter, tx_type, item_code, sort_by, ascending)
+    start = max(page - 1, 0) * page_size
+    page_df = _build_tx_index(branch, version)["df"].take(positions[start:start + page_size])
+    return page_df[TX_COLUMNS].reset_index(drop=True), len(positions)
+
+
+def get_transaction_summary(date_filter: date | None = None, tx_type: str | None = None,
+                            item_code: str | None = None, branch: str | None = None) -> dict:
+    """Count, in/out totals and per-item / per-requester breakdowns (cached)."""
+    branch = _resolve_branch(branch)
+    return _fetch_tx_summary(branch, _snapshot_version("tx", branch), date_filter, tx_type, item_code)
+
+
+# ─── Daily Movement Aggregates (materialized, updated incrementally) ────────
+
+
+def _parse_tx_date(val: str) -> date | None:
+    """Parse a dd/mm/yy sheet date, or None if it is not a valid date."""
+    try:
+        return datetime.strptime(str(val).strip(), "%d/%m/%y").date()
+    except ValueError:
+        return None
+
+
+@st.cache_resource(ttl=600)
+def _daily_movement_store(branch: str) -> dict:
+    """
+    Process-level store (one per branch) for (item code, day) → [approved in, approved out, tx count].
+    Built lazily from the ledger, then kept current by add/approve_transaction.
+    "rows" maps each sheet row already counted to its approval, so a change the
+    build already saw is not applied twice.
+    The 10-minute TTL forces a periodic rebuild to pick up edits made in Sheets.
+    """
+    return {"table": None, "rows": {}, "version": 0, "lock": threading.Lock()}
+
+
+def _build_daily_movements(branch: str) -> tuple[dict, dict]:
+    """
+    Aggregate the whole ledger into {(code, day): [in, out, count]} in one groupby.
+    Also returns {sheet row: approved} for the rows it counted.
+    """
+    df = pd.DataFrame(_fetch_tx_data(branch), columns=TX_COLUMNS)
+    rows = dict(zip(df["row_num"].tolist(), (df["Approve"] == "TRUE").tolist()))
+    day = pd.to_datetime(df["วันที่"], format="%d/%m/%y", errors="coerce")
+    df = df[day.notna()].assign(day=day.dt.date)
+    approved = df["Approve"] == "TRUE"
+    df["in_qty"] = df["จำนวน"].where(approved & (df["ประเภท"] == "รับเข้า"), 0.0)
+    df["out_qty"] = df["จำนวน"].where(approved & (df["ประเภท"] == "จ่ายออก"), 0.0)
+    agg = df.groupby(["รหัส", "day"]).agg(
+        in_qty=("in_qty", "sum"), out_qty=("out_qty", "sum"), count=("จำนวน", "size"),
+    )
+    table = {
+        key: [float(row.in_qty), float(row.out_qty), int(row.count)]
+        for key, row in zip(agg.index, agg.itertuples(index=False))
+    }
+    return table, rows
+
+
+def _get_daily_movement_table(branch: str) -> dict:
+    """Return the materialized table, building it on first use."""
+    store = _daily_movement_store(branch)
+    with store["lock"]:
+        if store["table"] is None:
+            store["table"], store["rows"] = _build_daily_movements(branch)
+            store["version"] = _next_version()
+        return store["table"]
+
+
+def _record_daily_movement(branch: str, row_num: int, item_code: str, day: date, tx_type: str,
+                           quantity: float, approved: bool):
+    """
+    Apply one ledger change (sheet row `row_num`) to the materialized table in place.
+    The row is counted as a transaction unless the table already holds it
+    (e.g. an approval of a row the build read as unapproved).
+    """
+    store = _daily_movement_store(branch)
+    with store["lock"]:
+        if store["table"] is None:
+            return  # not built yet — the next read builds it from the sheet
+        seen = store["rows"].get(row_num)
+        if seen is not None and (seen or not approved):
+            return  # the build already read this row in its current state
+        store["rows"][row_num] = approved
+        entry = store["table"].setdefault((item_code, day), [0.0, 0.0, 0])
+        if approved and tx_type == "รับเข้า":
+            entry[0] += quantity
+        elif approved and tx_type == "จ่ายออก":
+            entry[1] += quantity
+        if seen is None:
+            entry[2] += 1
+        store["version"] = _next_version()
+
+
+def get_movements_version(branch: str | None = None) -> int:
+    """Version of the daily aggregates, new on every change or rebuild (usable as a cache key)."""
+    branch = _resolve_branch(branch)
+    _get_daily_movement_table(branch)
+    return _daily_movement_store(branch)["version"]
+
+
+def get_items_version(branch: str | None = None) -> int:
+    """Version of the current items snapshot (usable as a cache key)."""
+    return _snapshot_version("items", _resolve_branch(branch))
+
+
+def get_daily_movements(item_code: str | None = None, start: date | None = None,
+                        end: date | None = None, branch: str | None = None) -> pd.DataFrame:
+    """
+    Per-item daily movements from the materialized table.
+    Columns: รหัส, วันที่ (date), รับเข้า, จ่ายออก, รายการ — approved quantities only.
+    """
+    table = _get_daily_movement_table(_resolve_branch(branch))
+    rows = [
+        (code, day, qty_in, qty_out, n)
+        for (code, day), (qty_in, qty_out, n) in list(table.items())
+        if (item_code is None or code == item_code)
+        and (start is None or day >= start)
+        and (end is None or day <= end)
+    ]
+    df = pd.DataFrame(rows, columns=["รหัส", "วันที่", "รับเข้า", "จ่ายออก", "รายการ"])
+    return df.sort_values(["วันที่", "รหัส"], ignore_index=True)
+
+
+def get_movement_totals(start: date | None = None, end: date | None = None,
+                        branch: str | None = None) -> pd.DataFrame:
+    """Approved in/out totals and transaction counts per item over a period."""
+    df = get_daily_movements(start=start, end=end, branch=branch)
+    return df.groupby("รหัส", as_index=False)[["รับเข้า", "จ่ายออก", "รายการ"]].sum()
+
+
+# ─── Point-in-time Stock (prefix sums over the ledger) ──────────────────────
+
+
+@st.cache_resource(ttl=600, max_entries=16)
+def _build_stock_prefix(branch: str, movements_version: int) -> dict:
+    """
+    Per-item cumulative approved in/out arrays ordered by day — CACHED per
+    (branch, movement version). code → (day ordinals, cumulative in, cumulative out).
+    Movement versions never repeat (even across Refresh / rebuilds), so an
+    entry is never reused for a different ledger state.
+    """
+    df = get_daily_movements(branch=branch).sort_values(["รหัส", "วันที่"], ignore_index=True)
+    if df.empty:
+        return {}  # no dated ledger rows yet (e.g. a freshly imported catalog)
+    days = np.fromiter((d.toordinal() for d in df["วันที่"]), dtype=np.int64, count=len(df))
+    cum_in = df.groupby("รหัส")["รับเข้า"].cumsum().to_numpy()
+    cum_out = df.groupby("รหัส")["จ่ายออก"].cumsum().to_numpy()
+    return {
+        code: (days[pos], cum_in[pos], cum_out[pos])
+        for code, pos in df.groupby("รหัส", sort=False).indices.items()
+    }
+
+
+def get_stock_as_of(as_of: date, branch: str | None = None) -> pd.DataFrame:
+    """
+    Stock balance and value of every item at the end of `as_of`.
+    One binary search per item over its prefix arrays. Valued at today's price.
+    """
+    branch = _resolve_branch(branch)
+    prefix = _build_stock_prefix(branch, get_movements_version(branch))
+    items = get_items_frame(branch).drop_duplicates("รหัส")
+    target = as_of.toordinal()
+
+    total_in, total_out = [], []
+    for code in items["รหัส"]:
+        days, cum_in, cum_out = prefix.get(code, ((), (), ()))
+        idx = int(np.searchsorted(days, target, side="right")) if len(days) else 0
+        total_in.append(float(cum_in[idx - 1]) if idx else 0.0)
+        total_out.append(float(cum_out[idx - 1]) if idx else 0.0)
+
+    result = items[["รหัส", "รายการวัตถุดิบ", "หมวดหมู่", "หน่วยนับ",
+                    "ราคา/หน่วย", "สต็อกขั้นต่ำ"]].reset_index(drop=True)
+    result["รับเข้าสะสม"] = total_in
+    result["จ่ายออกสะสม"] = total_out
+    result["คงเหลือ"] = result["รับเข้าสะสม"] - result["จ่ายออกสะสม"]
+    result["มูลค่าคงเหลือ"] = result["คงเหลือ"] * result["ราคา/หน่วย"]
+    return result
+
+
+# ─── Lot Ledger (first-expired-first-out) ───────────────────────────────────
+
+
+@st.cache_resource(ttl=600)
+def _lot_store(branch: str) -> dict:
+    """
+    Process-level lot ledger (one per branch). Each approved รับเข้า opens a lot; each approved
+    จ่ายออก is allocated against the item's earliest-expiring lots.
+      - lots:         item code → open lots sorted by (expiry, id)
+      - expiry_index: sorted (expiry, lot id) over every open lot
+      - rows:         sheet rows already applied, so a row is never applied twice
+    """
+    return {"lots": None, "by_id": {}, "expiry_index": [], "next_id": 0, "rows": set(),
+            "lock": threading.Lock()}
+
+
+def _lot_sort_key(lot: dict) -> tuple:
+    return lot["expiry"], lot["id"]
+
+
+def _open_lot(store: dict, item_code: str, received: date, shelf_life: int,
+              quantity: float, order: str = ""):
+    """Add a received lot to both indexes."""
+    lot = {
+        "id": store["next_id"],
+        "รหัส": item_code,
+        "Order": order,
+        "received": received,
+        "expiry": received + timedelta(days=max(shelf_life, 0)),
+        "qty": quantity,
+    }
+    store["next_id"] += 1
+    store["by_id"][lot["id"]] = lot
+    bisect.insort(store["lots"].setdefault(item_code, []), lot, key=_lot_sort_key)
+    bisect.insort(store["expiry_index"], _lot_sort_key(lot))
+
+
+def _allocate_fefo(store: dict, item_code: str, quantity: float) -> float:
+    """Consume quantity from the earliest-expiring lots; return any shortfall."""
+    open_lots = store["lots"].get(item_code, [])
+    while quantity > 1e-9 and open_lots:
+        lot = open_lots[0]
+        taken = min(lot["qty"], quantity)
+        lot["qty"] -= taken
+        quantity -= taken
+        if lot["qty"] <= 1e-9:
+            open_lots.pop(0)
+            del store["by_id"][lot["id"]]
+            idx = bisect.bisect_left(store["expiry_index"], _lot_sort_key(lot))
+            del store["expiry_index"][idx]
+    return quantity
+
+
+def _build_lots(store: dict, branch: str):
+    """Replay the approved ledger in date order to rebuild all open lots."""
+    txs = [
+        (day, t) for t in _fetch_tx_data(branch)
+        if t["Approve"] == "TRUE" and (day := _parse_tx_date(t["วันที่"]))
+    ]
+    store.update({"lots": {}, "by_id": {}, "expiry_index": [], "next_id": 0,
+                  "rows": {t["row_num"] for _, t in txs}})
+    txs.sort(key=lambda pair: (pair[0], pair[1]["row_num"]))
+    for day, t in txs:
+        if t["ประเภท"] == "รับเข้า":
+            _open_lot(store, t["รหัส"], day, t["อายุ"], t["จำนวน"], t["Order"])
+        elif t["ประเภท"] == "จ่ายออก":
+            _allocate_fefo(store, t["รหัส"], t["จำนวน"])
+
+
+def _get_lot_store(branch: str) -> dict:
+    """Return the lot store, building it on first use."""
+    store = _lot_store(branch)
+    with store["lock"]:
+        if store["lots"] is None:
+            _build_lots(store, branch)
+    return store
+
+
+def _record_lot_movement(branch: str, row_num: int, item_code: str, day: date, tx_type: str,
+                         quantity: float, shelf_life: int, order: str = ""):
+    """Apply one approved ledger row (sheet row `row_num`) to the lot ledger in place."""
+    store = _lot_store(branch)
+    with store["lock"]:
+        if store["lots"] is None:
+            return  # not built yet — the next read replays the sheet
+        if row_num in store["rows"]:
+            return  # the build already replayed this row
+        store["rows"].add(row_num)
+        if tx_type == "รับเข้า":
+            _open_lot(store, item_code, day, shelf_life, quantity, order)
+        elif tx_type == "จ่ายออก":
+            _allocate_fefo(store, item_code, quantity)
+
+
+def _lot_row(lot: dict, today: date) -> dict:
+    return {
+        "รหัส": lot["รหัส"],
+        "Order": lot["Order"],
+        "รับเข้า": lot["received"],
+        "หมดอายุ": lot["expiry"],
+        "คงเหลือ": lot["qty"],
+        "เหลือ(วัน)": (lot["expiry"] - today).days,
+    }
+
+
+def get_expiring_lots(within_days: int, branch: str | None = None) -> list[dict]:
+    """
+    Open lots expiring within N days (already-expired lots included), soonest first.
+    Binary search on the expiry index — cost grows with the number of hits only.
+    """
+    store = _get_lot_store(_resolve_branch(branch))
+    today = thai_today()
+    cutoff = today + timedelta(days=within_days)
+    with store["lock"]:
+        end = bisect.bisect_right(store["expiry_index"], (cutoff, float("inf")))
+        return [_lot_row(store["by_id"][lot_id], today)
+                for _, lot_id in store["expiry_index"][:end]]
+
+
+def get_item_lots(item_code: str, branch: str | None = None) -> list[dict]:
+    """Open lots for one item in FEFO order (next to be issued first)."""
+    store = _get_lot_store(_resolve_branch(branch))
+    today = thai_today()
+    with store["lock"]:
+        return [_lot_row(lot, today) for lot in store["lots"].get(item_code, [])]
 
 
 # ─── Category → Prefix mapping ──────────────────────────────────────────────
@@ -324,89 +1038,157 @@ CATEGORY_PREFIX = {
 }
 
 
-def _generate_item_code(category: str) -> str:
+def _max_code_numbers(branch: str) -> dict[str, int]:
+    """
+    Highest number ever used per code prefix, in one pass.
+    Scans BOTH current items AND all RP-PO history so deleted codes are never reused.
+    """
+    max_nums: dict[str, int] = {}
+    codes = [item["รหัส"] for item in get_all_items(branch)]
+    codes += [tx["รหัส"] for tx in get_all_transactions(branch)]
+    for code in codes:
+        prefix, _, num = code.partition("-")
+        try:
+            max_nums[prefix] = max(max_nums.get(prefix, 0), int(num))
+        except ValueError:
+            pass
+    return max_nums
+
+
+def _generate_item_code(category: str, branch: str) -> str:
     """
     Generate a unique item code for a category.
     Scans BOTH current items AND all RP-PO history to find the highest
     number ever used, then increments. This ensures codes are never reused.
     """
     prefix = CATEGORY_PREFIX.get(category, "OT")
-    max_num = 0
+    return f"{prefix}-{_max_code_numbers(branch).get(prefix, 0) + 1:04d}"
 
-    # Scan current items
-    items = get_all_items()
-    for item in items:
-        code = item["รหัส"]
-        if code.startswith(prefix + "-"):
-            try:
-                num = int(code.split("-")[1])
-                max_num = max(max_num, num)
-            except (ValueError, IndexError):
-                pass
-
-    # Scan RP-PO history for codes that may have been deleted
-    txs = get_all_transactions()
-    for tx in txs:
-        code = tx["รหัส"]
-        if code.startswith(prefix + "-"):
-            try:
-                num = int(code.split("-")[1])
-                max_num = max(max_num, num)
-            except (ValueError, IndexError):
-                pass
 
-    return f"{prefix}-{max_num + 1:04d}"
+def _allocate_item_codes(categories: list[str], branch: str) -> list[str]:
+    """Pre-allocate consecutive codes for many new items with a single scan."""
+    next_nums = _max_code_numbers(branch)
+    codes = []
+    for category in categories:
+        prefix = CATEGORY_PREFIX.get(category, "OT")
+        next_nums[prefix] = next_nums.get(prefix, 0) + 1
+        codes.append(f"{prefix}-{next_nums[prefix]:04d}")
+    return codes
+
+
+# ─── Item Row Index (รหัส → sheet row) ──────────────────────────────────────
+#
+# delete_rows shifts every later row up, so a row_num from a cached read can
+# point at the wrong item. Writes are addressed by รหัส instead: the index maps
+# code → row, is shifted in place on insert/delete, and each lookup is checked
+# with a single-cell read of column A before writing.
+
+
+@st.cache_resource(ttl=600)
+def _item_row_store(branch: str) -> dict:
+    """
+    Process-level code → row index for one branch's items sheet.
+    "marks" keeps, per code, the tx snapshot version behind the last stock write.
+    """
+    return {"rows": None, "marks": {}, "lock": threading.Lock()}
+
+
+def _load_item_rows(ws) -> dict[str, int]:
+    """Rebuild code → row from column A only (one narrow read)."""
+    codes = _retry_api_call(lambda: ws.col_values(1))
+    return {str(c).strip(): i + 1 for i, c in enumerate(codes) if i > 0 and str(c).strip()}
+
+
+def _locate_item_row(store: dict, ws, code: str) -> int:
+    """
+    Return the verified sheet row of an item. Caller must hold store["lock"].
+    Raises ValueError if the code is no longer on the sheet.
+    """
+    if store["rows"] is None:
+        store["rows"] = _load_item_rows(ws)
+    row_num = store["rows"].get(code)
+    if row_num is not None:
+        found = _retry_api_call(lambda: ws.acell(f"A{row_num}").value)
+        if str(found or "").strip() == code:
+            return row_num
+    # Index is stale (sheet edited elsewhere) — rebuild once and retry.
+    store["rows"] = _load_item_rows(ws)
+    if code not in store["rows"]:
+        raise ValueError(f"ไม่พบรหัสสินค้า {code} ในชีต (อาจถูกลบไปแล้ว)")
+    return store["rows"][code]
 
 
 # ─── Write Functions (clear cache after write) ──────────────────────────────
 
 
 def add_item(name: str, category: str, unit: str,
-             price: float, min_qty: float, current_qty: float, shelf_life: int):
+             price: float, min_qty: float, current_qty: float, shelf_life: int,
+             branch: str | None = None):
     """
     Add a new item with auto-generated code.
     Code is generated in Python (not ARRAYFORMULA) to prevent reuse after deletion.
     """
-    code = _generate_item_code(category)
-    ws = get_items_sheet()
+    branch = _resolve_branch(branch)
+    code = _generate_item_code(category, branch)
+    ws = get_items_sheet(branch)
     status = "ต้องสั่ง" if current_qty < min_qty else "ปกติ"
     value = current_qty * price
 
-    col_b = _retry_api_call(lambda: ws.col_values(2))
-    next_row = len(col_b) + 1
-
-    # Write A:J (code is now Python-generated, not ARRAYFORMULA)
-    _retry_api_call(lambda: ws.update(
-        f"A{next_row}:J{next_row}",
-        [[code, name, category, unit, price, min_qty, current_qty, status, value, shelf_life]],
-        value_input_option="USER_ENTERED",
-    ))
-
-    clear_items_cache()
+    store = _item_row_store(branch)
+    with store["lock"]:
+        col_b = _retry_api_call(lambda: ws.col_values(2))
+        next_row = len(col_b) + 1
+
+        # Write A:J (code is now Python-generated, not ARRAYFORMULA)
+        _retry_api_call(lambda: ws.update(
+            f"A{next_row}:J{next_row}",
+            [[code, name, category, unit, price, min_qty, current_qty, status, value, shelf_life]],
+            value_input_option="USER_ENTERED",
+        ))
+        if store["rows"] is not None:
+            store["rows"][code] = next_row
+
+    clear_items_cache(branch)
     return code
 
 
-def update_item(row_num: int, name: str, category: str,
-                unit: str, price: float, min_qty: float, shelf_life: int):
-    """Update an item — clears items cache after."""
-    ws = get_items_sheet()
-    _retry_api_call(lambda: ws.update(f"B{row_num}:F{row_num}", [[name, category, unit, price, min_qty]]))
-    _retry_api_call(lambda: ws.update(f"J{row_num}", [[shelf_life]]))
-    clear_items_cache()
-
-
-def delete_item(row_num: int):
-    """Delete an item — clears items cache after."""
-    ws = get_items_sheet()
-    _retry_api_call(lambda: ws.delete_rows(row_num))
-    clear_items_cache()
-
-
-def recalculate_item_stock(item_code: str):
+def update_item(code: str, name: str, category: str,
+                unit: str, price: float, min_qty: float, shelf_life: int,
+                branch: str | None = None):
+    """Update an item by code — clears items cache after."""
+    branch = _resolve_branch(branch)
+    ws = get_items_sheet(branch)
+    store = _item_row_store(branch)
+    with store["lock"]:
+        row_num = _locate_item_row(store, ws, code)
+        _retry_api_call(lambda: ws.batch_update([
+            {"range": f"B{row_num}:F{row_num}", "values": [[name, category, unit, price, min_qty]]},
+            {"range": f"J{row_num}", "values": [[shelf_life]]},
+        ]))
+    clear_items_cache(branch)
+
+
+def delete_item(code: str, branch: str | None = None):
+    """Delete an item by code — shifts the row index in place, clears items cache after."""
+    branch = _resolve_branch(branch)
+    ws = get_items_sheet(branch)
+    store = _item_row_store(branch)
+    with store["lock"]:
+        row_num = _locate_item_row(store, ws, code)
+        _retry_api_call(lambda: ws.delete_rows(row_num))
+        del store["rows"][code]
+        for other, row in store["rows"].items():
+            if row > row_num:
+                store["rows"][other] = row - 1
+    clear_items_cache(branch)
+
+
+def recalculate_item_stock(item_code: str, branch: str | None = None):
     """Recalculate stock for an item from transactions and update sheet."""
+    branch = _resolve_branch(branch)
     # Force fresh data for recalculation
-    clear_all_cache()
-    items = get_all_items()
+    clear_all_cache(branch)
+    items = get_all_items(branch)
     item = None
     for it in items:
         if it["รหัส"] == item_code:
@@ -415,71 +1197,454 @@ def recalculate_item_stock(item_code: str):
     if not item:
         return
 
-    txs = get_all_transactions()
+    ledger = _get_snapshot("tx", branch)
+    _write_item_stock(branch, item, _approved_balance(ledger["rows"], item_code), ledger["version"])
+    clear_items_cache(branch)
+
+
+def _write_item_stock(branch: str, item: dict, current_qty: float, ledger_version: int):
+    """
+    Write G:I of one item at its verified row (skipped if the code is gone).
+    Also skipped if a stock write already used a later ledger read, so a slow
+    writer can't overwrite a newer total. Ledger loads are serialized, and any
+    change to the sheet (new row, approval, manual edit) gives the next load a
+    higher snapshot version, so the version orders reads.
+    """
+    ws = get_items_sheet(branch)
+    store = _item_row_store(branch)
+    with store["lock"]:
+        if ledger_version < store["marks"].get(item["รหัส"], 0):
+            return
+        store["marks"][item["รหัส"]] = ledger_version
+        try:
+            row_num = _locate_item_row(store, ws, item["รหัส"])
+        except ValueError:
+            return
+        _retry_api_call(lambda: ws.update(
+            f"G{row_num}:I{row_num}",
+            [_stock_cells(item, current_qty)],
+            value_input_option="USER_ENTERED",
+        ))
+
+
+def _approved_balance(txs: list[dict], item_code: str) -> float:
+    """Approved รับเข้า minus approved จ่ายออก for one item."""
     total_in = sum(t["จำนวน"] for t in txs if t["รหัส"] == item_code and t["ประเภท"] == "รับเข้า" and t["Approve"] == "TRUE")
     total_out = sum(t["จำนวน"] for t in txs if t["รหัส"] == item_code and t["ประเภท"] == "จ่ายออก" and t["Approve"] == "TRUE")
+    return total_in - total_out
 
-    current_qty = total_in - total_out
-    price = item["ราคา/หน่วย"]
-    min_qty = item["สต็อกขั้นต่ำ"]
-    status = "ต้องสั่ง" if current_qty < min_qty else "ปกติ"
-    value = current_qty * price
 
-    ws = get_items_sheet()
-    row_num = item["row_num"]
-    _retry_api_call(lambda: ws.update(
-        f"G{row_num}:I{row_num}",
-        [[current_qty, status, value]],
-        value_input_option="USER_ENTERED",
-    ))
+def _stock_cells(item: dict, current_qty: float) -> list:
+    """G:I values (คงเหลือจริง, สถานะ, มูลค่า) for an item at a given stock level."""
+    status = "ต้องสั่ง" if current_qty < item["สต็อกขั้นต่ำ"] else "ปกติ"
+    return [current_qty, status, current_qty * item["ราคา/หน่วย"]]
+
 
-    clear_items_cache()
+@st.cache_resource
+def _append_locks() -> dict:
+    """branch → asyncio.Lock serializing next-row lookup + row write (used on the I/O loop only)."""
+    return {}
+
+
+async def _add_transaction_async(branch: str, item_code: str, item_name: str, tx_type: str,
+                                 quantity: float, shelf_life: int, requester: str,
+                                 approve: bool, today: date) -> tuple[int, str | None]:
+    """
+    Write a transaction with independent calls grouped into concurrent rounds:
+    (1) next-row read + item lookup, (2) the row write, (3) order readback +
+    ledger re-read (which also refreshes the tx snapshot), (4) the stock cell
+    update from that re-read. Returns (sheet row, order number).
+    """
+    ws = get_tx_sheet(branch)
+    life_str = (today + timedelta(days=shelf_life)).strftime("%d/%m/%y")
+
+    # Two submissions must not both claim the same next row.
+    async with _append_locks().setdefault(branch, asyncio.Lock()):
+        all_vals, item = await asyncio.gather(
+            _aretry_api_call(lambda: ws.get_all_values()),
+            asyncio.to_thread(get_item_by_code, item_code, branch),
+        )
+        next_row = len(all_vals) + 1 if all_vals else 2
+
+        # Batch write: A (Approve) + C:K (data) in ONE API call
+        await _aretry_api_call(lambda: ws.batch_update([
+            {
+                "range": f"A{next_row}",
+                "values": [[str(approve).upper()]],
+            },
+            {
+                "range": f"C{next_row}:K{next_row}",
+                "values": [[today.strftime("%d/%m/%y"), item_code, item_name, tx_type,
+                            quantity, shelf_life, life_str, shelf_life, requester]],
+            },
+        ], value_input_option="USER_ENTERED"))
+        clear_all_cache(branch)
+
+    # Stock comes from a ledger read taken after the write, so concurrent
+    # submissions for the same item each see the other's row.
+    order_num, tx_snap = await asyncio.gather(
+        _aretry_api_call(lambda: ws.cell(next_row, 2).value),
+        asyncio.to_thread(_reload_snapshot, "tx", branch),
+    )
+    if item is not None:
+        current_qty = _approved_balance(tx_snap["rows"], item_code)
+        await asyncio.to_thread(_write_item_stock, branch, item, current_qty,
+                                tx_snap["version"])
+        clear_items_cache(branch)
+    return next_row, order_num
 
 
 def add_transaction(item_code: str, item_name: str, tx_type: str,
                     quantity: float, shelf_life: int, requester: str,
-                    approve: bool = True):
-    """Add a transaction — uses batch_update for atomic write."""
-    ws = get_tx_sheet()
-
+                    approve: bool = True, branch: str | None = None):
+    """Add a transaction — one batch_update for the row, follow-up calls run concurrently."""
+    branch = _resolve_branch(branch)
     today = thai_today()
-    today_str = today.strftime("%d/%m/%y")
-    life_date = today + timedelta(days=shelf_life)
-    life_str = life_date.strftime("%d/%m/%y")
-    remaining_days = shelf_life
-
-    # Find next empty row
-    all_vals = _retry_api_call(lambda: ws.get_all_values())
-    next_row = len(all_vals) + 1 if all_vals else 2
+    next_row, order_num = _run_async(_add_transaction_async(
+        branch, item_code, item_name, tx_type, quantity, shelf_life, requester, approve, today,
+    ))
+    order_num = order_num or f"ROW-{next_row}"
 
-    # Batch write: A (Approve) + C:K (data) in ONE API call
-    _retry_api_call(lambda: ws.batch_update([
-        {
-            "range": f"A{next_row}",
-            "values": [[str(approve).upper()]],
-        },
-        {
-            "range": f"C{next_row}:K{next_row}",
-            "values": [[today_str, item_code, item_name, tx_type,
-                        quantity, shelf_life, life_str, remaining_days, requester]],
-        },
-    ], value_input_option="USER_ENTERED"))
-
-    clear_all_cache()
-
-    # Recalculate stock
-    recalculate_item_stock(item_code)
-
-    # Read back order number
-    order_num = _retry_api_call(lambda: ws.cell(next_row, 2).value) or f"ROW-{next_row}"
+    _record_daily_movement(branch, next_row, item_code, today, tx_type, quantity, approve)
+    if approve:
+        _record_lot_movement(branch, next_row, item_code, today, tx_type, quantity, shelf_life,
+                             str(order_num))
     return str(order_num)
 
 
-def approve_transaction(row_num: int):
+def approve_transaction(row_num: int, branch: str | None = None):
     """Set Approve to TRUE for a transaction row."""
-    ws = get_tx_sheet()
+    branch = _resolve_branch(branch)
+    ws = get_tx_sheet(branch)
+    row = _retry_api_call(lambda: ws.row_values(row_num)) or []
+    row += [""] * (len(TX_HEADERS) - len(row))
     _retry_api_call(lambda: ws.update(f"A{row_num}", [["TRUE"]], value_input_option="USER_ENTERED"))
-    item_code = _retry_api_call(lambda: ws.cell(row_num, 4).value)
+    item_code = str(row[3]).strip()
     if item_code:
-        recalculate_item_stock(item_code.strip())
-    clear_all_cache()
+        day = _parse_tx_date(row[2])
+        if day and str(row[0]).strip().upper() != "TRUE":
+            tx_type, quantity = str(row[5]).strip(), _safe_float(row[6])
+            _record_daily_movement(branch, row_num, item_code, day, tx_type, quantity, approved=True)
+            _record_lot_movement(branch, row_num, item_code, day, tx_type, quantity,
+                                 _safe_int(row[7]), str(row[1]).strip())
+        recalculate_item_stock(item_code, branch)
+    clear_all_cache(branch)
+
+
+def recalculate_all_stock(item_codes: list[str] | None = None, branch: str | None = None):
+    """
+    Recalculate stock for many items from fresh transactions and write every
+    G:I range in ONE batch_update (instead of one recalculation per item).
+    """
+    branch = _resolve_branch(branch)
+    clear_all_cache(branch)
+    items = pd.DataFrame(get_all_items(branch), columns=ITEMS_FRAME_COLUMNS)
+    items = items[items["รหัส"] != ""].drop_duplicates("รหัส")
+    if item_codes is not None:
+        items = items[items["รหัส"].isin(item_codes)]
+    if items.empty:
+        return
+
+    ledger = _get_snapshot("tx", branch)
+    mark = ledger["version"]
+    txs = pd.DataFrame(ledger["rows"], columns=TX_COLUMNS)
+    approved = txs[txs["Approve"] == "TRUE"]
+    sign = approved["ประเภท"].map({"รับเข้า": 1.0, "จ่ายออก": -1.0}).fillna(0.0)
+    net = (approved["จำนวน"] * sign).groupby(approved["รหัส"]).sum()
+
+    current_qty = items["รหัส"].map(net).fillna(0.0)
+    status = np.where(current_qty < items["สต็อกขั้นต่ำ"], "ต้องสั่ง", "ปกติ")
+    value = current_qty * items["ราคา/หน่วย"]
+
+    # Rows come from the code index, refreshed by one column-A read for the
+    # whole batch, and the write happens under the index lock.
+    ws = get_items_sheet(branch)
+    store = _item_row_store(branch)
+    with store["lock"]:
+        store["rows"] = _load_item_rows(ws)
+        updates = [
+            {"range": f"G{row_num}:I{row_num}", "values": [[float(qty), str(state), float(val)]]}
+            for code, qty, state, val in zip(items["รหัส"], current_qty, status, value)
+            if (row_num := store["rows"].get(code)) is not None
+            and mark >= store["marks"].get(code, 0)
+        ]
+        store["marks"].update({code: mark for code in items["รหัส"]
+                               if mark >= store["marks"].get(code, 0)})
+        if updates:
+            _retry_api_call(lambda: ws.batch_update(updates, value_input_option="USER_ENTERED"))
+
+    clear_items_cache(branch)
+
+
+# ─── Bulk Import / Export ───────────────────────────────────────────────────
+
+IMPORT_CHUNK_ROWS = 1000  # rows per write call — keeps 50k rows to ~50 API calls
+
+ITEMS_IMPORT_COLUMNS = {
+    "รายการวัตถุดิบ": "", "หมวดหมู่": "", "หน่วยนับ": "",
+    "ราคา/หน่วย": 0.0, "สต็อกขั้นต่ำ": 0.0, "คงเหลือจริง": 0.0, "อายุการเก็บ (วัน)": 0,
+}
+TX_IMPORT_COLUMNS = {
+    "วันที่": "", "รหัส": "", "ประเภท": "", "จำนวน": 0.0,
+    "requestner": "", "Approve": "TRUE",
+}
+
+
+def read_import_file(file, filename: str) -> pd.DataFrame:
+    """Read an uploaded CSV or Parquet file into a DataFrame."""
+    if filename.lower().endswith(".parquet"):
+        return pd.read_parquet(file)
+    return pd.read_csv(file, dtype=str, keep_default_na=False)
+
+
+def _missing_columns(df: pd.DataFrame, required: list[str]) -> list[str]:
+    return [f"ไม่พบคอลัมน์ '{c}'" for c in required if c not in df.columns]
+
+
+def _import_text(raw: pd.Series) -> pd.Series:
+    """Stripped text of an import column; nulls (e.g. from Parquet) become ""."""
+    return raw.astype(object).fillna("").astype(str).str.strip()
+
+
+def _row_errors(mask: pd.Series, message: str) -> list[str]:
+    """Turn a boolean 'bad row' mask into messages (file row numbers, 1 = header)."""
+    return [f"แถว {i + 2}: {message}" for i in np.flatnonzero(mask.to_numpy())[:20]]
+
+
+def validate_items_import(df: pd.DataFrame) -> tuple[pd.DataFrame, list[str]]:
+    """Normalize an items file; return (clean rows, error messages)."""
+    errors = _missing_columns(df, ["รายการวัตถุดิบ", "หมวดหมู่", "หน่วยนับ"])
+    if errors:
+        return df.iloc[0:0], errors
+
+    out = pd.DataFrame(index=df.index)
+    for col, default in ITEMS_IMPORT_COLUMNS.items():
+        raw = df[col] if col in df.columns else pd.Series(default, index=df.index)
+        if isinstance(default, str):
+            out[col] = _import_text(raw)
+        else:
+            # Optional numeric columns: a blank cell takes the column default
+            text = _import_text(raw).str.replace(",", "")
+            out[col] = pd.to_numeric(text.mask(text == "", str(default)), errors="coerce")
+
+    errors += _row_errors(out["รายการวัตถุดิบ"] == "", "ไม่มีชื่อวัตถุดิบ")
+    errors += _row_errors(out["หน่วยนับ"] == "", "ไม่มีหน่วยนับ")
+    numeric = ["ราคา/หน่วย", "สต็อกขั้นต่ำ", "คงเหลือจริง", "อายุการเก็บ (วัน)"]
+    errors += _row_errors(out[numeric].isna().any(axis=1) | (out[numeric] < 0).any(axis=1),
+                          "ตัวเลขไม่ถูกต้อง")
+    out["อายุการเก็บ (วัน)"] = out["อายุการเก็บ (วัน)"].fillna(0).astype(int)
+    return out.reset_index(drop=True), errors
+
+
+def validate_tx_import(df: pd.DataFrame, branch: str | None = None) -> tuple[pd.DataFrame, list[str]]:
+    """
+    Normalize a transactions file; return (clean rows, error messages).
+    รายการ and อายุ are filled from the items master by รหัส.
+    """
+    errors = _missing_columns(df, ["วันที่", "รหัส", "ประเภท", "จำนวน"])
+    if errors:
+        return df.iloc[0:0], errors
+
+    out = pd.DataFrame(index=df.index)
+    for col, default in TX_IMPORT_COLUMNS.items():
+        raw = df[col] if col in df.columns else pd.Series(default, index=df.index)
+        out[col] = raw if col == "วันที่" else _import_text(raw)
+
+    day = out["วันที่"]
+    if not pd.api.types.is_datetime64_any_dtype(day):
+        text = day.astype(str).str.strip()
+        day = pd.to_datetime(text, format="%Y-%m-%d", errors="coerce")
+        for fmt in ("%d/%m/%y", "%d/%m/%Y"):
+            day = day.fillna(pd.to_datetime(text, format=fmt, errors="coerce"))
+    out["จำนวน"] = pd.to_numeric(out["จำนวน"].str.replace(",", ""), errors="coerce")
+    out["Approve"] = out["Approve"].str.upper().replace("", "TRUE")
+
+    items = pd.DataFrame(get_all_items(branch), columns=ITEMS_FRAME_COLUMNS).drop_duplicates("รหัส")
+    items = items.set_index("รหัส")
+    out["รายการ"] = out["รหัส"].map(items["รายการวัตถุดิบ"])
+    out["อายุ"] = out["รหัส"].map(items["อายุการเก็บ (วัน)"])
+
+    errors += _row_errors(day.isna(), "วันที่ไม่ถูกต้อง")
+    errors += _row_errors(out["รายการ"].isna(), "ไม่พบรหัสสินค้า")
+    errors += _row_errors(~out["ประเภท"].isin(["รับเข้า", "จ่ายออก"]), "ประเภทต้องเป็น รับเข้า หรือ จ่ายออก")
+    errors += _row_errors(~(out["จำนวน"] > 0), "จำนวนต้องมากกว่า 0")
+    errors += _row_errors(~out["Approve"].isin(["TRUE", "FALSE"]), "Approve ต้องเป็น TRUE หรือ FALSE")
+
+    life = day + pd.to_timedelta(out["อายุ"].fillna(0), unit="D")
+    out["วันที่"] = day.dt.strftime("%d/%m/%y")
+    out["life"] = life.dt.strftime("%d/%m/%y")
+    out["อายุ"] = out["อายุ"].fillna(0).astype(int)
+    return out.reset_index(drop=True), errors
+
+
+def _ensure_rows(ws, last_row: int):
+    """Grow the worksheet grid so explicit-range writes up to last_row fit."""
+    if last_row > ws.row_count:
+        _retry_api_call(lambda: ws.add_rows(last_row - ws.row_count))
+
+
+def import_items(df: pd.DataFrame, start: int = 0, progress=None,
+                 branch: str | None = None) -> int:
+    """
+    Append validated item rows in chunked writes, resuming at row `start`.
+    Codes for all remaining rows are allocated in one scan.
+    `progress(done, total)` is called after each chunk; returns rows written.
+    """
+    rows = df.iloc[start:]
+    if rows.empty:
+        return start
+    branch = _resolve_branch(branch)
+    ws = get_items_sheet(branch)
+
+    qty = rows["คงเหลือจริง"].astype(float)
+    values = pd.DataFrame({
+        "รหัส": _allocate_item_codes(rows["หมวดหมู่"].tolist(), branch),
+        "รายการวัตถุดิบ": rows["รายการวัตถุดิบ"],
+        "หมวดหมู่": rows["หมวดหมู่"],
+        "หน่วยนับ": rows["หน่วยนับ"],
+        "ราคา/หน่วย": rows["ราคา/หน่วย"],
+        "สต็อกขั้นต่ำ": rows["สต็อกขั้นต่ำ"],
+        "คงเหลือจริง": qty,
+        "สถานะการสั่ง": np.where(qty < rows["สต็อกขั้นต่ำ"], "ต้องสั่ง", "ปกติ"),
+        "มูลค่าคงเหลือ": qty * rows["ราคา/หน่วย"],
+        "อายุการเก็บ (วัน)": rows["อายุการเก็บ (วัน)"],
+    }).astype(object).values.tolist()
+
+    next_row = len(_retry_api_call(lambda: ws.col_values(2))) + 1
+    _ensure_rows(ws, next_row + len(values) - 1)
+    store = _item_row_store(branch)
+
+    done = start
+    try:
+        for offset in range(0, len(values), IMPORT_CHUNK_ROWS):
+            chunk = values[offset:offset + IMPORT_CHUNK_ROWS]
+            first = next_row + offset
+            _retry_api_call(lambda: ws.update(
+                f"A{first}:J{first + len(chunk) - 1}", chunk,
+                value_input_option="USER_ENTERED",
+            ))
+            with store["lock"]:
+                if store["rows"] is not None:
+                    store["rows"].update({row[0]: first + i for i, row in enumerate(chunk)})
+            done += len(chunk)
+            if progress:
+                progress(done, len(df))
+    finally:
+        clear_items_cache(branch)
+    return done
+
+
+def import_transactions(df: pd.DataFrame, start: int = 0, progress=None,
+                        branch: str | None = None) -> int:
+    """
+    Append validated transaction rows in chunked batch_update calls, resuming
+    at row `start`. Column B (Order) is left to the sheet, as in add_transaction.
+    Stock for every touched item is recalculated once at the end.
+    """
+    rows = df.iloc[start:]
+    if rows.empty:
+        return start
+    branch = _resolve_branch(branch)
+    ws = get_tx_sheet(branch)
+
+    approve = rows["Approve"].tolist()
+    # C:K — the initial เวลาเหลือ equals อายุ, as in add_transaction
+    data = rows[["วันที่", "รหัส", "รายการ", "ประเภท", "จำนวน", "อายุ", "life", "อายุ", "requestner"]]
+    data = data.astype(object).values.tolist()
+
+    all_vals = _retry_api_call(lambda: ws.get_all_values())
+    next_row = len(all_vals) + 1 if all_vals else 2
+    _ensure_rows(ws, next_row + len(data) - 1)
+
+    done = start
+    try:
+        for offset in range(0, len(data), IMPORT_CHUNK_ROWS):
+            chunk = data[offset:offset + IMPORT_CHUNK_ROWS]
+            first, last = next_row + offset, next_row + offset + len(chunk) - 1
+            _retry_api_call(lambda: ws.batch_update([
+                {"range": f"A{first}:A{last}",
+                 "values": [[a] for a in approve[offset:offset + len(chunk)]]},
+                {"range": f"C{first}:K{last}", "values": chunk},
+            ], value_input_option="USER_ENTERED"))
+            done += len(chunk)
+            if progress:
+                progress(done, len(df))
+    finally:
+        clear_all_cache(branch)
+        clear_materialized(branch)
+
+    recalculate_all_stock(df["รหัส"].unique().tolist(), branch)
+    return done
+
+
+def _to_parquet(df: pd.DataFrame) -> bytes:
+    buf = io.BytesIO()
+    df.to_parquet(buf, index=False)
+    return buf.getvalue()
+
+
+def export_items_parquet(branch: str | None = None) -> bytes:
+    """Export the items sheet as Parquet bytes."""
+    return _to_parquet(pd.DataFrame(get_all_items(branch), columns=ITEMS_FRAME_COLUMNS).drop(columns="row_num"))
+
+
+def export_transactions_parquet(branch: str | None = None) -> bytes:
+    """Export the transactions sheet as Parquet bytes."""
+    return _to_parquet(pd.DataFrame(get_all_transactions(branch), columns=TX_COLUMNS).drop(columns="row_num"))
+
+
+# ─── Multi-branch Consolidation ─────────────────────────────────────────────
+
+BRANCH_FETCH_WORKERS = 8
+
+
+def _fetch_branch_snapshot(branch: str) -> pd.DataFrame:
+    """Items of one branch tagged with the branch name (per-branch caches)."""
+    return get_items_frame(branch).assign(สาขา=branch)
+
+
+def get_consolidated_items(branches: list[str] | None = None) -> tuple[pd.DataFrame, dict[str, str]]:
+    """
+    Fetch every branch's items concurrently through the shared gspread client.
+    Returns (all items with a สาขา column, {branch: error message} for failures).
+    Each branch hits its own cache entry, so refreshing one leaves the others warm.
+    """
+    branches = branches or list(get_branches())
+    frames, errors = [], {}
+    with ThreadPoolExecutor(max_workers=min(BRANCH_FETCH_WORKERS, len(branches))) as pool:
+        futures = {pool.submit(_fetch_branch_snapshot, b): b for b in branches}
+        for future in as_completed(futures):
+            try:
+                frames.append(future.result())
+            except Exception as e:
+                errors[futures[future]] = str(e)
+    if not frames:
+        return pd.DataFrame(columns=ITEMS_FRAME_COLUMNS + ["สาขา"]), errors
+    return pd.concat(frames, ignore_index=True), errors
+
+
+def summarize_branches(items: pd.DataFrame) -> pd.DataFrame:
+    """Per-branch totals: item count, items below minimum and stock value."""
+    return items.groupby("สาขา").agg(
+        สินค้าทั้งหมด=("รหัส", "size"),
+        ต่ำกว่ามาตรฐาน=("สถานะสต็อก", lambda s: int((s == STOCK_STATUS_LOW).sum())),
+        มูลค่ารวม=("มูลค่าคงเหลือ", "sum"),
+    ).reset_index()
+
+
+def consolidate_stock(items: pd.DataFrame) -> pd.DataFrame:
+    """
+    Stock and restock needs per item across branches.
+    Each branch numbers its own codes, so items are matched by รหัส together with
+    name and unit. A code that means different items in different branches stays
+    on separate rows, listed with the branches it comes from.
+    Needs are summed per branch, so one branch's surplus does not hide another's shortage.
+    """
+    return items.groupby(["รหัส", "รายการวัตถุดิบ", "หน่วยนับ"]).agg(
+        สาขา=("สาขา", lambda s: ", ".join(sorted(set(s)))),
+        คงเหลือรวม=("คงเหลือจริง", "sum"),
+        ขั้นต่ำรวม=("สต็อกขั้นต่ำ", "sum"),
+        ต้องเติมรวม=("need_to_restock", "sum"),
+        สาขาที่ต้องเติม=("need_to_restock", lambda s: int((s > 0).sum())),
+        มูลค่ารวม=("มูลค่าคงเหลือ", "sum"),
+    ).reset_index().sort_values("ต้องเติมรวม", ascending=False, ignore_index=True)
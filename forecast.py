@@ -0,0 +1,103 @@
+"""
+Consumption-rate forecasting and reorder suggestions.
+
+Runs as one vectorized batch over the whole catalog:
+  - daily จ่ายออก per item comes from the materialized movement table
+  - rolling-window average usage → days until stockout
+  - suggested order quantity, capped by shelf life so stock isn't ordered
+    faster than it can be used
+
+Cached per data version, so it only recomputes after the items sheet or ledger changes.
+"""
+
+import streamlit as st
+import numpy as np
+import pandas as pd
+from datetime import date, timedelta
+
+import database as db
+
+# ─── Defaults ────────────────────────────────────────────────────────────────
+
+USAGE_WINDOW_DAYS = 14   # rolling window for average daily usage
+LEAD_TIME_DAYS = 2       # days between ordering and receiving
+COVER_DAYS = 7           # days of usage an order should cover
+
+FORECAST_URGENT = "🔴 สั่งด่วน"
+FORECAST_ORDER = "🟡 ควรสั่ง"
+FORECAST_OK = "🟢 เพียงพอ"
+
+
+# ─── Batch computation ───────────────────────────────────────────────────────
+
+
+def _usage_matrix(branch: str, today: date, days: int) -> pd.DataFrame:
+    """Days × items matrix of approved จ่ายออก quantities, zero-filled."""
+    start = today - timedelta(days=days - 1)
+    days_index = pd.date_range(start, today).date
+    moves = db.get_daily_movements(start=start, end=today, branch=branch)
+    if moves.empty:
+        return pd.DataFrame(index=days_index, dtype=float)
+    matrix = moves.pivot_table(index="วันที่", columns="รหัส", values="จ่ายออก",
+                               aggfunc="sum", fill_value=0.0)
+    return matrix.reindex(days_index, fill_value=0.0)
+
+
+@st.cache_data(ttl=db.CACHE_TTL)
+def _compute_suggestions(branch: str, items_version: int, movements_version: int, today: date,
+                         window_days: int, lead_time_days: int, cover_days: int) -> pd.DataFrame:
+    """
+    Forecast every item in one pass — CACHED per (branch, data versions, parameters).
+    The version arguments are only part of the cache key: items edits (min
+    stock, shelf life, prices) and ledger changes each invalidate it.
+    """
+    items = db.get_items_frame(branch).drop_duplicates("รหัส")
+    codes = items["รหัส"].to_numpy()
+
+    # Two windows of history: the latest window gives current usage,
+    # the one before it gives the trend.
+    rolling = _usage_matrix(branch, today, window_days * 2).rolling(window_days, min_periods=1).mean()
+    rolling = rolling.reindex(columns=codes, fill_value=0.0)
+    usage = rolling.iloc[-1].to_numpy()
+    prior_usage = rolling.iloc[window_days - 1].to_numpy()
+
+    stock = items["คงเหลือจริง"].to_numpy(dtype=float)
+    min_qty = items["สต็อกขั้นต่ำ"].to_numpy(dtype=float)
+    shelf = items["อายุการเก็บ (วัน)"].to_numpy(dtype=float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days_left = np.where(usage > 0, np.maximum(stock, 0) / usage, np.inf)
+
+    # Cover lead time + target days, but never more days than the item keeps.
+    cover = np.minimum(lead_time_days + cover_days, np.where(shelf > 0, shelf, np.inf))
+    suggested = np.clip(usage * cover + min_qty - stock, 0, None)
+
+    status = np.select(
+        [days_left <= lead_time_days, suggested > 0],
+        [FORECAST_URGENT, FORECAST_ORDER],
+        default=FORECAST_OK,
+    )
+
+    result = items[["รหัส", "รายการวัตถุดิบ", "หมวดหมู่", "หน่วยนับ",
+                    "คงเหลือจริง", "สต็อกขั้นต่ำ", "อายุการเก็บ (วัน)", "ราคา/หน่วย"]].copy()
+    result["ใช้เฉลี่ย/วัน"] = usage
+    result["แนวโน้ม"] = usage - prior_usage
+    result["เหลืออีก (วัน)"] = np.where(np.isfinite(days_left), days_left, np.nan)
+    result["คาดว่าหมด"] = [
+        today + timedelta(days=int(d)) if d < 3650 else None for d in days_left
+    ]
+    result["แนะนำสั่ง"] = suggested
+    result["มูลค่าสั่ง"] = suggested * result["ราคา/หน่วย"].to_numpy(dtype=float)
+    result["สถานะ"] = status
+    return result.sort_values(["เหลืออีก (วัน)", "แนะนำสั่ง"],
+                              ascending=[True, False], ignore_index=True)
+
+
+def get_reorder_suggestions(window_days: int = USAGE_WINDOW_DAYS,
+                            lead_time_days: int = LEAD_TIME_DAYS,
+                            cover_days: int = COVER_DAYS,
+                            branch: str | None = None) -> pd.DataFrame:
+    """Return usage forecast and suggested order quantity for every item (cached)."""
+    branch = branch if branch is not None else db.get_current_branch()
+    return _compute_suggestions(branch, db.get_items_version(branch), db.get_movements_version(branch),
+                                db.thai_today(), window_days, lead_time_days, cover_days)
@@ -0,0 +1,132 @@
+"""
+Item search index for the item pickers.
+
+Built once per (branch, items version, movement version) and shared across
+sessions:
+  - code, name and category are normalized (NFC, lowercase, Thai tone marks
+    and zero-width characters removed) so spelling variants still match
+  - a sorted token list answers prefix queries with a binary search
+  - character bigrams give fuzzy matches for typos
+  - results are ranked by match quality, then by recent usage in the ledger
+"""
+
+import streamlit as st
+import bisect
+import re
+import unicodedata
+from datetime import timedelta
+
+import database as db
+
+# ─── Settings ────────────────────────────────────────────────────────────────
+
+USAGE_DAYS = 30        # ledger window used to rank frequently moved items
+FUZZY_MIN_SCORE = 0.4  # minimum bigram similarity for a fuzzy match
+
+# Tone marks, thanthakhat, mai taikhu and zero-width characters often differ
+# between how an item was typed into the sheet and how it is searched.
+_STRIP_CHARS = dict.fromkeys(
+    map(ord, "็่้๊๋์​‌‍﻿"), None
+)
+_SEPARATORS = re.compile(r"[\s\-_/.,:;()\[\]]+")
+
+
+def normalize(text: str) -> str:
+    """Normalize text for matching (Thai-aware, case-insensitive)."""
+    text = unicodedata.normalize("NFC", str(text)).lower().translate(_STRIP_CHARS)
+    text = text.replace("ํา", "ำ")  # nikhahit + sara aa → sara am
+    return _SEPARATORS.sub(" ", text).strip()
+
+
+def _bigrams(text: str) -> set[str]:
+    text = text.replace(" ", "")
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+# ─── Index ───────────────────────────────────────────────────────────────────
+
+
+@st.cache_resource(max_entries=8)
+def _build_index(branch: str, items_version: int, movements_version: int) -> dict:
+    """
+    Build the search index for one branch — CACHED per data version.
+    The version arguments are only part of the cache key.
+    """
+    items = [it for it in db.get_all_items(branch) if it["รหัส"]]
+    start = db.thai_today() - timedelta(days=USAGE_DAYS - 1)
+    totals = db.get_movement_totals(start=start, branch=branch)
+    usage = dict(zip(totals["รหัส"], totals["รายการ"]))
+
+    texts, codes, tokens = [], [], []
+    for idx, it in enumerate(items):
+        code, name = normalize(it["รหัส"]), normalize(it["รายการวัตถุดิบ"])
+        text = f"{code} {name} {normalize(it['หมวดหมู่'])}"
+        texts.append(text)
+        codes.append(code.replace(" ", ""))
+        # Words, plus the whole code and name without separators
+        # (Thai names are often written without spaces).
+        words = set(text.split()) | {codes[-1], name.replace(" ", "")}
+        tokens.extend((tok, idx) for tok in words)
+    tokens.sort()
+
+    return {
+        "items": items,
+        "codes": codes,
+        "texts": texts,
+        "tokens": tokens,
+        "token_keys": [tok for tok, _ in tokens],
+        "bigrams": [_bigrams(t) for t in texts],
+        "usage": [int(usage.get(it["รหัส"], 0)) for it in items],
+    }
+
+
+def _get_index(branch: str | None = None) -> dict:
+    branch = branch if branch is not None else db.get_current_branch()
+    return _build_index(branch, db.get_items_version(branch), db.get_movements_version(branch))
+
+
+def search_items(query: str, limit: int = 20, branch: str | None = None) -> list[dict]:
+    """
+    Return up to `limit` items best matching `query`.
+    Exact code > code prefix > word prefix > substring > fuzzy; ties go to
+    items moved most often in the last USAGE_DAYS days. An empty query
+    returns the most-used items.
+    """
+    index = _get_index(branch)
+    q = normalize(query)
+    scores: dict[int, float] = {}
+
+    if q:
+        # Prefix hits (codes included) from the sorted token list — one
+        # binary search per query word instead of a catalog scan.
+        compact = q.replace(" ", "")
+        keys, tokens, codes = index["token_keys"], index["tokens"], index["codes"]
+        for word in {compact} | set(q.split()):
+            pos = bisect.bisect_left(keys, word)
+            while pos < len(keys) and keys[pos].startswith(word):
+                idx = tokens[pos][1]
+                if keys[pos] == codes[idx] and word == compact:
+                    score = 100 if keys[pos] == compact else 90
+                else:
+                    score = 70
+                scores[idx] = max(scores.get(idx, 0), score)
+                pos += 1
+        # Scans below run only when prefix hits don't fill the list.
+        if len(scores) < limit:
+            for idx, text in enumerate(index["texts"]):
+                if idx not in scores and q in text:
+                    scores[idx] = 50
+        if len(scores) < limit:
+            q_grams = _bigrams(q)
+            for idx, grams in enumerate(index["bigrams"]):
+                if idx in scores:
+                    continue
+                sim = len(q_grams & grams) / len(q_grams | grams)
+                if sim >= FUZZY_MIN_SCORE or len(q_grams & grams) / len(q_grams) >= 0.75:
+                    scores[idx] = 40 * max(sim, 0.5)
+    else:
+        scores = dict.fromkeys(range(len(index["items"])), 0)
+
+    usage = index["usage"]
+    ranked = sorted(scores, key=lambda i: (-scores[i], -usage[i], index["codes"][i]))
+    return [index["items"][i] for i in ranked[:limit]]